@@ -0,0 +1,67 @@
+"""Benchmark batch voltage to EC conversion against the scalar path
+
+Run from the top-level directory with:
+
+    python -m benchmarks.bench_ec_conversion [--samples 1000000]
+"""
+
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.ec_calibrator import (
+    ECREF,
+    RES2,
+    CalibrationData,
+    calc_ec,
+    calc_ec_batch,
+)
+
+
+def best_time(func, repeat):
+    """Return the result and the fastest of repeat timings of func."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    """Time the scalar and batch conversions and check that they agree."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Raw EC from 0 to 20 ms/cm so both kvalues are exercised
+    voltages = rng.uniform(0.0, 20.0 * RES2 * ECREF / 1000.0, args.samples)
+    temperatures = rng.uniform(10.0, 35.0, args.samples)
+    calibration_data = CalibrationData(kvalue_low=1.05, kvalue_high=0.97)
+
+    voltage_list = voltages.tolist()
+    temperature_list = temperatures.tolist()
+    scalar, scalar_time = best_time(
+        lambda: [
+            calc_ec(v, t, calibration_data)
+            for v, t in zip(voltage_list, temperature_list)
+        ],
+        args.repeat,
+    )
+    batch, batch_time = best_time(
+        lambda: calc_ec_batch(voltages, temperatures, calibration_data), args.repeat
+    )
+    if not np.allclose(batch, scalar):
+        raise RuntimeError("Batch and scalar conversions differ")
+
+    print(f"samples: {args.samples}")
+    print(f"scalar: {scalar_time:.4f} s ({args.samples / scalar_time:,.0f} samples/s)")
+    print(f"batch:  {batch_time:.4f} s ({args.samples / batch_time:,.0f} samples/s)")
+    print(f"speed-up: {scalar_time / batch_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark streaming export of the EC history against writing it row by row
+
+Run from the top-level directory with:
+
+    python -m benchmarks.bench_export [--records 2000000]
+
+The history is written to a temporary file and exported as CSV with the csv module one
+row at a time, then with the chunked CSV and npz exports. The time to read the file is
+shown for comparison: an export limited by the disk would take about as long.
+"""
+
+from argparse import ArgumentParser
+import csv
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.ec_history import HISTORY_DTYPE, EcHistory
+from hydrocontrol_ui.hydrocontrol.export import (
+    EC_AGGREGATION,
+    FORMAT_CSV,
+    FORMAT_NPZ,
+    export,
+    history_chunks,
+)
+
+
+def consume(parts):
+    """Read an export to the end and return its size in bytes."""
+    return sum(len(part) for part in parts)
+
+
+def row_by_row_csv(records):
+    """Write records as CSV with the csv module, one row at a time."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(records.dtype.names)
+    size = 0
+    for row in records:
+        writer.writerow(row.tolist())
+        if output.tell() > 1 << 20:
+            size += len(output.getvalue())
+            output.seek(0)
+            output.truncate()
+    return size + len(output.getvalue())
+
+
+def main():
+    """Time the row by row and chunked exports of a generated EC history."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=2_000_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    records = np.zeros(args.records, dtype=HISTORY_DTYPE)
+    records["time"] = 1.7e9 + np.arange(args.records) * 10.0
+    records["voltage"] = rng.uniform(0.5, 2.0, args.records)
+    records["temperature"] = rng.uniform(15.0, 25.0, args.records)
+    records["ec"] = rng.uniform(0.5, 2.0, args.records)
+    records["ec_corrected"] = records["ec"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history = EcHistory(os.path.join(tmp_dir, "ec-history.bin"))
+        records.tofile(history.history_file)
+        file_size = os.path.getsize(history.history_file)
+
+        def run(name, func):
+            start = time.perf_counter()
+            size = func()
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:<22}{elapsed:>8.3f} s {size / 1e6:>8.1f} MB "
+                f"{args.records / elapsed:>12,.0f} records/s"
+            )
+
+        print(f"records: {args.records} ({file_size / 1e6:.1f} MB)")
+        run("read file", lambda: len(history.records().tobytes()))
+        run("csv row by row", lambda: row_by_row_csv(history.records()))
+        for export_format in (FORMAT_CSV, FORMAT_NPZ):
+            run(
+                f"{export_format} chunked",
+                lambda f=export_format: consume(
+                    export(
+                        history_chunks(history.records()),
+                        HISTORY_DTYPE,
+                        EC_AGGREGATION,
+                        f,
+                    )
+                ),
+            )
+        run(
+            "csv hourly",
+            lambda: consume(
+                export(
+                    history_chunks(history.records()),
+                    HISTORY_DTYPE,
+                    EC_AGGREGATION,
+                    FORMAT_CSV,
+                    resolution=3600,
+                )
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
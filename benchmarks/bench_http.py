@@ -0,0 +1,356 @@
+"""Load test and latency benchmark for the Flask endpoints
+
+The app is driven with a mock HydroController that runs in a background thread and
+receives EC readings from a fake broker (a LocalTransport), so the views contend with
+a controller for the shared AppState just as they do on the Pi.
+
+Run from the top-level directory with:
+
+    python -m benchmarks.bench_http [--server] [--save-baseline FILE] [--baseline FILE]
+
+By default requests go through the Flask test client; with --server they are made over
+HTTP to a threaded werkzeug server. Results are compared against a stored baseline if
+one is given and the exit status is 1 if any endpoint has regressed. Baselines should be
+saved on the same hardware and in the same mode as the run they are compared with.
+"""
+
+from argparse import ArgumentParser
+import http.client
+import json
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+from werkzeug.serving import make_server
+
+from hydrocontrol_ui import app
+from hydrocontrol_ui.hydrocontrol import mqtt_util
+from hydrocontrol_ui.hydrocontrol.ec_calibrator import (
+    CalibrationData,
+    CalibrationStatus,
+)
+from hydrocontrol_ui.hydrocontrol.state_classes import AppConfig, AppState
+from hydrocontrol_ui.hydrocontrol.transport import LocalTransport
+from hydrocontrol_ui.hydrocontrol.usage import UsageRollups
+
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16)
+REQUESTS_PER_CLIENT = 200
+ALLOCATION_SAMPLES = 50
+# Fractional change in a metric that is reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# Endpoint name: (method, path, form data)
+ENDPOINTS = {
+    "status": ("GET", "/status", None),
+    "control": (
+        "POST",
+        "/control",
+        {
+            "mode": "control",
+            "target-ec": "1.8",
+            "dose-volume": "5",
+            "equilibration-time": "30",
+        },
+    ),
+    "dose": ("POST", "/dose", {"manual-dose-volume": "2"}),
+    "calibrate_ec": ("POST", "/calibrate_ec", {"calibrate-ecprobe-temperature": "25"}),
+}
+
+APP_STATE = AppState(calibration_data=CalibrationData(), usage=UsageRollups())
+app.config["APP_STATE"] = APP_STATE
+# pylint: disable=wrong-import-position, unused-import
+from hydrocontrol_ui import views  # noqa: E402
+
+
+class MockHydroController:
+    """Mimics the HydroController loop without pumps, mqtt-io or a broker.
+
+    EC readings are published on a LocalTransport and handled by the same mqtt_util
+    callbacks as a real client, while the control loop services dose and calibration
+    requests made through the views.
+    """
+
+    def __init__(self, state: AppState, loop_delay: float = 0.001):
+        self.state = state
+        self.loop_delay = loop_delay
+        self.topics = mqtt_util.setup_mqtt_topics(AppConfig())
+        self.transport = LocalTransport()
+        self.transport.on_connect = mqtt_util.create_on_connect(
+            [mqtt_util.ID_EC], self.topics
+        )
+        self.transport.on_message = mqtt_util.create_on_message(state, self.topics)
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        """Start the control loop and the fake sensor."""
+        self._running = True
+        self.transport.connect()
+        self.transport.loop_start()
+        for target in (self._control_loop, self._sensor_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop all the threads."""
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self.transport.loop_stop()
+
+    def _sensor_loop(self):
+        while self._running:
+            self.transport.publish(self.topics[mqtt_util.ID_EC], random.uniform(1, 2))
+            time.sleep(self.loop_delay)
+
+    def _control_loop(self):
+        state = self.state
+        while self._running:
+            if state.calibration_data.status == CalibrationStatus.CALIBRATING:
+                state.calibration_data.status = CalibrationStatus.CALIBRATED
+                state.calibration_data.message = "Calibrated"
+            if state.manual_dose:
+                state.dose_count += 1
+                state.total_dose_volume += state.manual_dose_volume
+                state.usage.record_dose(
+                    time.time(), state.manual_dose_volume, state.manual_dose_volume
+                )
+                state.manual_dose = False
+            if state.control and state.current_ec < state.target_ec:
+                state.last_dose_time = time.time()
+            time.sleep(self.loop_delay)
+
+
+class TestClientRequester:
+    """Makes requests through the Flask test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data):
+        """Make a request and return the status code."""
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code
+
+
+class HttpRequester:
+    """Makes requests over HTTP to a running server."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, data):
+        """Make a request and return the status code."""
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        body = None
+        headers = {}
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_load(make_requester, endpoint, concurrency, requests_per_client):
+    """Hit one endpoint from concurrency clients and return throughput and latencies."""
+    method, path, data = ENDPOINTS[endpoint]
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+
+    def client(index):
+        requester = make_requester()
+        barrier.wait()
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            status = requester.request(method, path, data)
+            latencies[index].append(time.perf_counter() - start)
+            if status != 200:
+                errors[index] += 1
+
+    threads = [
+        threading.Thread(target=client, args=(i,)) for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarise_load(latencies, errors, elapsed)
+
+
+def summarise_load(latencies, errors, elapsed):
+    """Throughput and latency percentiles from the latencies of each client."""
+    all_latencies = sorted(l for client_latencies in latencies for l in client_latencies)
+    return {
+        "rps": len(all_latencies) / elapsed,
+        "p50_ms": 1000 * percentile(all_latencies, 0.50),
+        "p95_ms": 1000 * percentile(all_latencies, 0.95),
+        "p99_ms": 1000 * percentile(all_latencies, 0.99),
+        "errors": sum(errors),
+    }
+
+
+def measure_allocations(endpoint, samples):
+    """Mean peak memory of a request and number of memory blocks it leaves allocated.
+
+    The retained blocks are from the difference of tracemalloc snapshots taken before
+    and after each request.
+    """
+    method, path, data = ENDPOINTS[endpoint]
+    requester = TestClientRequester()
+    requester.request(method, path, data)  # warm up caches
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    for _ in range(samples):
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        requester.request(method, path, data)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        peaks.append(peak - current)
+        blocks.append(
+            sum(
+                stat.count_diff
+                for stat in after.compare_to(before, "lineno")
+                if stat.count_diff > 0
+            )
+        )
+    tracemalloc.stop()
+    return {
+        "peak_kib": statistics.fmean(peaks) / 1024,
+        "retained_blocks": statistics.fmean(blocks),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of descriptions of metrics that have regressed from the baseline."""
+    regressions = []
+    for endpoint, levels in results.items():
+        for level, metrics in levels.items():
+            base = baseline.get(endpoint, {}).get(level)
+            if not base:
+                continue
+            for metric, value in metrics.items():
+                if metric not in base or metric == "errors":
+                    continue
+                old = base[metric]
+                if metric == "rps":
+                    regressed = value < old * (1 - tolerance)
+                else:
+                    regressed = value > old * (1 + tolerance)
+                if regressed:
+                    regressions.append(
+                        f"{endpoint} [{level}] {metric}: {old:.3f} -> {value:.3f}"
+                    )
+    return regressions
+
+
+def start_server():
+    """Serve the app over HTTP on a free port, returning the server."""
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def print_results(results):
+    """Print a table of the results for each endpoint and number of clients."""
+    print(f"{'endpoint':<14}{'clients':>8}{'req/s':>10}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for endpoint, levels in results.items():
+        for level, metrics in levels.items():
+            if level == "alloc":
+                continue
+            print(
+                f"{endpoint:<14}{level:>8}{metrics['rps']:>10.0f}"
+                f"{metrics['p50_ms']:>9.3f}{metrics['p95_ms']:>9.3f}"
+                f"{metrics['p99_ms']:>9.3f}{metrics['errors']:>8}"
+            )
+        alloc = levels["alloc"]
+        print(
+            f"{endpoint:<14} per request: peak {alloc['peak_kib']:.1f} KiB, "
+            f"{alloc['retained_blocks']:.1f} blocks retained"
+        )
+
+
+def check_baseline(results, baseline_file, tolerance):
+    """Print any regressions from the baseline and exit with status 1 if there are."""
+    with open(baseline_file, "r", encoding="utf-8") as file_handle:
+        baseline = json.load(file_handle)
+    regressions = compare(results, baseline, tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    """Run the benchmark and compare it with or save it as a baseline."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--server", action="store_true", help="Benchmark over HTTP")
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=list(CONCURRENCY_LEVELS)
+    )
+    parser.add_argument("--requests", type=int, default=REQUESTS_PER_CLIENT)
+    parser.add_argument("--baseline", help="Baseline results file to compare against")
+    parser.add_argument("--save-baseline", help="Write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    # Measure allocations first as tracemalloc counts allocations in every thread
+    results = {
+        endpoint: {"alloc": measure_allocations(endpoint, ALLOCATION_SAMPLES)}
+        for endpoint in ENDPOINTS
+    }
+
+    controller = MockHydroController(APP_STATE)
+    controller.start()
+    server = start_server() if args.server else None
+
+    def make_requester():
+        if server is None:
+            return TestClientRequester()
+        return HttpRequester(server.server_port)
+
+    try:
+        for endpoint in ENDPOINTS:
+            for concurrency in args.concurrency:
+                results[endpoint][str(concurrency)] = run_load(
+                    make_requester, endpoint, concurrency, args.requests
+                )
+    finally:
+        if server is not None:
+            server.shutdown()
+        controller.stop()
+
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file_handle:
+            json.dump(results, file_handle, indent=2)
+    if args.baseline:
+        check_baseline(results, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
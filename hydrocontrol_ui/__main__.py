@@ -31,11 +31,14 @@ logging.basicConfig(
 # This is where we pass the shared app_state object to flask so that both it
 # and the hydrocontroller can see the same state
 app.config["APP_STATE"] = app_state
+app.config["APP_CONFIG"] = app_config
 
 # In debug mode flask forks intself so we don't want to start the controller twice
 # https://raspberrypi.stackexchange.com/questions/148825/lgpio-gpio-setup-fails-with-gpio-not-allocated-when-run-from-a-flask-app
 if not is_running_from_reloader():
-    hydro_controller = controller.HydroController(app_config, app_state)
+    hydro_controller = controller.HydroController(
+        app_config, app_state, config_file
+    )
     thread = threading.Thread(target=hydro_controller.run)
 
 from . import views  # pylint: disable=wrong-import-position, unused-import
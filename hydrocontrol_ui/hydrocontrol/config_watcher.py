@@ -0,0 +1,172 @@
+"""Watch the application config file and pick up changes without restarting"""
+
+import dataclasses
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, Tuple, Union
+
+from hydrocontrol_ui.hydrocontrol.ec_calibrator import read_calibration
+from hydrocontrol_ui.hydrocontrol.pump_calibrator import read_pump_calibration
+from hydrocontrol_ui.hydrocontrol.sensors import read_sensor_registry
+from hydrocontrol_ui.hydrocontrol.state_classes import (
+    AppConfig,
+    AppState,
+    load_config,
+)
+
+PY310 = sys.version_info >= (3, 10)
+# AppState fields that are only ever set at runtime and so are never taken from the file
+RUNTIME_STATE_FIELDS = (
+    "calibration_data",
+    "config_error",
+    "pump_calibration",
+    "usage",
+    "sensors",
+)
+
+_LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class ConfigChanges:
+    """The differences between the running config and an edited config file.
+
+    app maps AppConfig field names to (old, new) values, state maps AppState field
+    names to the new value and previous_state maps them to the running value.
+    """
+
+    app: Dict[str, Tuple[Any, Any]] = dataclasses.field(default_factory=dict)
+    state: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    previous_state: Dict[str, Any] = dataclasses.field(default_factory=dict)
+
+    def __bool__(self):
+        return bool(self.app or self.state)
+
+
+class ConfigWatcher:
+    """Polls the config file modification time and validates and diffs any edits."""
+
+    def __init__(
+        self,
+        config_file: str,
+        app_config: AppConfig,
+        app_state: AppState,
+        poll_interval: float = 5.0,
+    ):
+        self.config_file = config_file
+        self.app_config = app_config
+        self.app_state = app_state
+        self.poll_interval = poll_interval
+        self._last_poll = time.monotonic()
+        self._signature = self._file_signature()
+        # The state section as last read from the file. State is changed at runtime by
+        # the UI, so we only apply state values that have been edited in the file.
+        try:
+            _, self._file_state = load_config(config_file)
+        except (OSError, ValueError) as e:
+            _LOG.warning("Cannot read config file %s: %s", config_file, e)
+            self._file_state = AppState()
+        self._previous_file_state = self._file_state
+
+    def _file_signature(self) -> Union[Tuple[int, int], None]:
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self) -> Union[ConfigChanges, None]:
+        """Return the changes if the config file has been edited since the last poll.
+
+        Invalid edits are rejected: the running config is left untouched and the error
+        is recorded in AppState.config_error so that it is visible in /status.
+        """
+        now = time.monotonic()
+        if now - self._last_poll < self.poll_interval:
+            return None
+        self._last_poll = now
+
+        signature = self._file_signature()
+        if signature == self._signature:
+            return None
+        self._signature = signature
+        if signature is None:
+            self.reject(f"Config file {self.config_file} has been removed")
+            return None
+
+        try:
+            new_config, new_state = load_config(self.config_file)
+            self.validate(new_config)
+        except (OSError, ValueError) as e:
+            self.reject(str(e))
+            return None
+
+        changes = self.diff(new_config, new_state)
+        self._previous_file_state = self._file_state
+        self._file_state = new_state
+        self.app_state.config_error = ""
+        if changes:
+            _LOG.info("Config file %s changed: %s", self.config_file, changes)
+        return changes
+
+    def validate(self, new_config: AppConfig) -> None:
+        """Checks that need the filesystem rather than just the file contents.
+
+        Any calibration files or mqtt-io config that the edit would load are read, so
+        that problems with them reject the edit before anything is changed.
+        """
+        if not os.path.isfile(new_config.mqttio_config_file):
+            raise ValueError(
+                f"Cannot find mqttio_config_file: {new_config.mqttio_config_file}"
+            )
+        # The sensor registry is rebuilt from the mqtt-io config by several changes
+        read_sensor_registry(
+            new_config.mqttio_config_file, new_config.sensor_history_size
+        )
+        for name, read in (
+            ("ec_calibration_file", read_calibration),
+            ("pump_calibration_file", read_pump_calibration),
+        ):
+            file_path = getattr(new_config, name)
+            if file_path == getattr(self.app_config, name):
+                continue
+            try:
+                read(file_path)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                raise ValueError(f"Cannot read {name} {file_path}: {e}") from e
+
+    def diff(self, new_config: AppConfig, new_state: AppState) -> ConfigChanges:
+        """Compute the changes between the running and new configurations."""
+        changes = ConfigChanges()
+        for field in dataclasses.fields(AppConfig):
+            old = getattr(self.app_config, field.name)
+            new = getattr(new_config, field.name)
+            if old != new:
+                changes.app[field.name] = (old, new)
+        for field in dataclasses.fields(AppState):
+            if field.name in RUNTIME_STATE_FIELDS:
+                continue
+            new = getattr(new_state, field.name)
+            if getattr(self._file_state, field.name) != new:
+                changes.state[field.name] = new
+                changes.previous_state[field.name] = getattr(
+                    self.app_state, field.name
+                )
+        return changes
+
+    def revert(self, changes: ConfigChanges, message: str) -> None:
+        """Restore the running config after changes failed to apply and reject them."""
+        for name, (old, _) in changes.app.items():
+            setattr(self.app_config, name, old)
+        for name, old in changes.previous_state.items():
+            setattr(self.app_state, name, old)
+        self._file_state = self._previous_file_state
+        self.reject(message)
+
+    def reject(self, message: str) -> None:
+        """Record an invalid config edit."""
+        message = f"Config file edit rejected: {message}"
+        _LOG.error(message)
+        self.app_state.config_error = message
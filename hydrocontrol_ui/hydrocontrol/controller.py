@@ -1,65 +1,172 @@
 """Farm Urban Hydroponics Control System"""
 
+import copy
 import logging
+import math
 import os
 import socket
 import subprocess
 import sys
+import threading
 import time
-from typing import Callable
+from typing import Callable, Dict, Union
 
-import paho.mqtt.client as mqtt
 from mqtt_io.modules.sensor.drivers.dfr0566_driver import (
     DFRobotExpansionBoardIIC,
     DFRobotExpansionBoardServo,
 )
 
+from hydrocontrol_ui.hydrocontrol.config_watcher import ConfigChanges, ConfigWatcher
 from hydrocontrol_ui.hydrocontrol.state_classes import (
     AppConfig,
     AppState,
     process_config,
 )
 from hydrocontrol_ui.hydrocontrol.ec_calibrator import (
+    CALIBRATION_TEMPERATURE,
     CalibrationStatus,
+    calc_voltage,
+    mqttio_temperature_sensor,
+    read_calibration,
     run_calibration,
 )
+from hydrocontrol_ui.hydrocontrol.dose_history import DoseHistory
+from hydrocontrol_ui.hydrocontrol.ec_history import EcHistory, reprocess
+from hydrocontrol_ui.hydrocontrol.pump_calibrator import (
+    DEFAULT_FLOW_RATE,
+    PumpCalibrationStatus,
+    read_pump_calibration,
+    write_pump_calibration,
+)
+from hydrocontrol_ui.hydrocontrol.recipe import (
+    SENSOR_EC,
+    PumpConfig,
+    Recipe,
+    default_recipe,
+    pump_channels,
+)
+from hydrocontrol_ui.hydrocontrol.scheduler import DoseJob, DoseScheduler
+from hydrocontrol_ui.hydrocontrol.sensor_history import SensorHistory
+from hydrocontrol_ui.hydrocontrol.sensors import read_sensor_registry
+from hydrocontrol_ui.hydrocontrol.transport import create_transport
+from hydrocontrol_ui.hydrocontrol.usage import read_usage, write_usage
 
 
 ID_EC = "ec"
+# AppConfig fields that require a new connection to the MQTT broker when changed
+MQTT_CONNECTION_FIELDS = (
+    "mqtt_host",
+    "mqtt_port",
+    "mqtt_username",
+    "mqtt_password",
+    "mqtt_transport",
+    "mqtt_bridge",
+)
+# AppConfig fields that change the topics subscribed to
+SUBSCRIPTION_FIELDS = ("ec_prefix", "mqttio_config_file", "sensor_history_size")
+# Time in seconds before the end of a dose to stop sleeping and wait for the deadline
+PUMP_SPIN_TIME = 0.002
+# Fraction of each dose's timing error used to correct the overrun of the next one
+PUMP_DRIFT_GAIN = 0.5
+PUMP_MAX_OVERRUN = 0.25
 _LOG = logging.getLogger()
 
 
-class Pump:
-    """Class for running peristaltic dosing pump"""
+class PumpBoard:
+    """The DFRobot IO expansion board that drives the pump motors
 
-    def __init__(self, channel: int):
-        self.mock = False
-        self.channel = channel
-        try:
-            board = DFRobotExpansionBoardIIC(
-                1, 0x10
-            )  # Select i2c bus 1, set address to 0x10
-        except ModuleNotFoundError as e:
-            _LOG.error("Error importing pump driver modules: %s", e)
-            self.mock = True
-
-        if not self.mock:
-            self.servo = DFRobotExpansionBoardServo(board)
+    There is one board for all of the pumps, set up once. The pumps can run at the
+    same time from different threads, so access to the i2c bus is serialised.
+    """
+
+    def __init__(self):
+        board = DFRobotExpansionBoardIIC(1, 0x10)  # Select i2c bus 1, set address to 0x10
+        self.servo = DFRobotExpansionBoardServo(board)
+        self.lock = threading.Lock()
+        with self.lock:
             board.setup()
             self.servo.begin()
 
-    def run(self, dose_duration):
-        """Dose for a given duration
+    def move(self, channel: int, angle: int) -> None:
+        """Set the speed of the motor on a channel"""
+        with self.lock:
+            self.servo.move(channel, angle)
+
+
+def create_pump_board() -> Union[PumpBoard, None]:
+    """Return the pump board, or None if the driver modules can't be imported."""
+    try:
+        return PumpBoard()
+    except ModuleNotFoundError as e:
+        _LOG.error("Error importing pump driver modules: %s", e)
+        return None
+
+
+class Pump:
+    """Class for running peristaltic dosing pump
+
+    Doses are timed with the monotonic clock so they are unaffected by changes to the
+    system time. The time taken to start and stop the motor makes the pump run for
+    longer than requested, so the average overrun is measured and subtracted from the
+    following doses.
+
+    A pump without a board is a mock that doesn't drive the motor and sleeps for the
+    whole dose.
+    """
+
+    def __init__(
+        self,
+        channel: int,
+        flow_rate: float = DEFAULT_FLOW_RATE,
+        board: Union[PumpBoard, None] = None,
+    ):
+        self.board = board
+        self.mock = board is None
+        self.channel = channel
+        self.flow_rate = flow_rate  # ml/s
+        self.overrun = 0.0  # s
+
+    def run(self, dose_duration: float) -> float:
+        """Dose for a given duration in seconds and return the time actually run
         0 is full speed forward
         90 is stopped
         180 is full speed reverse
         """
-        _LOG.info("Dosing for %d seconds", dose_duration)
-        if not self.mock:
-            self.servo.move(self.channel, 0)
-        time.sleep(dose_duration)
-        if not self.mock:
-            self.servo.move(self.channel, 90)
+        if not (math.isfinite(dose_duration) and dose_duration >= 0):
+            raise ValueError(f"Invalid dose duration: {dose_duration}")
+        _LOG.info("Dosing for %.3f seconds", dose_duration)
+        spin_time = 0.0 if self.mock else PUMP_SPIN_TIME
+        start = time.monotonic()
+        deadline = start + max(0.0, dose_duration - self.overrun)
+        try:
+            if not self.mock:
+                self.board.move(self.channel, 0)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Sleep until just before the deadline and then wait it out
+                if remaining > spin_time:
+                    time.sleep(remaining - spin_time)
+        finally:
+            # Always stop the motor, even if the wait is interrupted
+            if not self.mock:
+                self.board.move(self.channel, 90)
+        run_time = time.monotonic() - start
+
+        error = run_time - dose_duration
+        self.overrun = min(
+            max(0.0, self.overrun + PUMP_DRIFT_GAIN * error), PUMP_MAX_OVERRUN
+        )
+        _LOG.debug("Pump ran for %.4f seconds (overrun %.4f)", run_time, self.overrun)
+        return run_time
+
+    def dose(self, volume: float) -> tuple:
+        """Dose a volume in ml and return the volume dosed and the time taken"""
+        if not (math.isfinite(volume) and volume > 0):
+            raise ValueError(f"Invalid dose volume: {volume}")
+        run_time = self.run(volume / self.flow_rate)
+        return run_time * self.flow_rate, run_time
 
 
 class MqttIo:
@@ -97,6 +204,11 @@ class MqttIo:
             _LOG.warning("MQTT_IO restart - process wasn't running.")
         self.start()
 
+    def stop(self):
+        """Stop the mqtt-io process"""
+        if self.process is not None and self.running():
+            self.process.kill()
+
     def running(self):
         """Check if the mqtt-io process is running"""
         self.process.poll()
@@ -104,27 +216,72 @@ class MqttIo:
 
 
 class HydroController:
-    """Class to control an autodosing hydroponics system"""
-
-    def __init__(self, app_config: AppConfig, current_state: AppState):
+    """Class to control an autodosing hydroponics system
+
+    With mock_pumps the pumps are simulated, e.g. to replay recorded MQTT traffic.
+    """
+
+    def __init__(
+        self,
+        app_config: AppConfig,
+        current_state: AppState,
+        config_file: str = None,
+        mock_pumps: bool = False,
+    ):
         self.current_state = current_state
         self.app_config = app_config
         self.loop_delay = 3
+        self.mock_pumps = mock_pumps
 
         self.mqttio_controller = MqttIo(self.app_config.mqttio_config_file)
+        # Time of the last valid EC reading, which is only dosed on while it's recent
+        self.ec_time: Union[float, None] = None
+        self.ec_stale = True
+        self.mqtt_error = ""  # Set while retrying a connection to the broker
         self.mqtt_client = self.setup_mqtt()
-        self.ec_pump = Pump(app_config.motor_channel)
+        if current_state.pump_calibration is None:
+            current_state.pump_calibration = read_pump_calibration(
+                app_config.pump_calibration_file
+            )
+        current_state.pump_calibration.channel = app_config.motor_channel
+        self.pump_board = None if mock_pumps else create_pump_board()
+        self.pumps: Dict[int, Pump] = {}
+        self.create_pumps()
+        self.dose_lock = threading.Lock()
+        self.ec_history = EcHistory(app_config.ec_history_file)
+        self.dose_history = DoseHistory(app_config.dose_history_file)
+        self.sensor_history = SensorHistory(app_config.sensor_history_dir)
+        if current_state.sensors is not None:
+            current_state.sensors.history = self.sensor_history
+        self.scheduler = DoseScheduler(
+            self.recipe(), current_state, self.dose, self.latest_reading
+        )
+        # Let the reservoir equilibrate after the last dose before dosing again
+        self.scheduler.hold(
+            current_state.last_dose_time
+            + current_state.equilibration_time
+            - time.time()
+        )
+        self.config_watcher = None
+        if config_file:
+            self.config_watcher = ConfigWatcher(config_file, app_config, current_state)
+        self.check_ec_compensation()
 
     def setup_mqtt(self):
         """Setup the MQTT client and subscribe to topics."""
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         host = self.app_config.mqtt_host
         port = self.app_config.mqtt_port
         username = self.app_config.mqtt_username
         password = self.app_config.mqtt_password
-        client.username_pw_set(username, password)
         try:
-            client.connect(host, port=port)
+            client = create_transport(
+                self.app_config.mqtt_transport,
+                host,
+                port,
+                username,
+                password,
+                bridge=self.app_config.mqtt_bridge,
+            )
         except (ConnectionRefusedError, socket.gaierror) as e:
             _LOG.error("Could not connect to MQTT broker: %s", e)
             raise e
@@ -138,12 +295,12 @@ class HydroController:
         """Create a callback to handle connection to MQTT broker."""
 
         def on_mqtt_connect(
-            client: mqtt.Client, _userdata, _connect_flags, _reason_code, _properties
+            client, _userdata, _connect_flags, _reason_code, _properties
         ):
             """Subscribe to topics on connect."""
             retcodes = []
             subscribed = []
-            for topic in self.mqtt_topics.values():
+            for topic in self.subscription_topics():
                 retcodes.append(client.subscribe(topic))
                 subscribed.append(topic)
             if all((retcode[0] == 0 for retcode in retcodes)):
@@ -153,6 +310,27 @@ class HydroController:
 
         return on_mqtt_connect
 
+    def subscription_topics(self) -> list:
+        """The topics for the controller and all of the mqtt-io sensors."""
+        topics = list(self.mqtt_topics.values())
+        if self.current_state.sensors is not None:
+            topics.extend(self.current_state.sensors.topics)
+        return list(dict.fromkeys(topics))
+
+    def update_subscriptions(self, old_topics: list):
+        """Subscribe to new topics and unsubscribe from ones no longer needed."""
+        new_topics = self.subscription_topics()
+        if self.mqtt_client is None:
+            # The topics are all subscribed to when the client connects
+            return
+        for topic in old_topics:
+            if topic not in new_topics:
+                self.mqtt_client.unsubscribe(topic)
+        for topic in new_topics:
+            if topic not in old_topics:
+                self.mqtt_client.subscribe(topic)
+        _LOG.info("Subscribed to topics: %s", new_topics)
+
     def create_on_message(self) -> Callable:
         """Create a callback to handle incoming MQTT messages."""
 
@@ -160,38 +338,180 @@ class HydroController:
             topic = message.topic
             payload = message.payload.decode("utf-8")
             _LOG.debug("Received message: %s %s", topic, payload)
+            if self.current_state.sensors is not None:
+                self.current_state.sensors.handle(topic, payload)
             if topic == self.mqtt_topics[ID_EC]:
                 try:
-                    self.current_state.current_ec = float(payload)
+                    ec = float(payload)
                 except ValueError as e:
                     _LOG.warning("Error getting EC: %s - %s", payload, e)
                     self.current_state.current_ec = -1.0
+                    self.ec_time = None
+                    return
+                self.process_ec(ec)
+            self.scheduler.notify()
 
         return on_mqtt_message
 
-    def control_ec(self):
-        """Control the EC level"""
-        if self.current_state.current_ec < self.current_state.target_ec:
-            if (
-                time.time() - self.current_state.last_dose_time
-                > self.current_state.equilibration_time
-            ):
-                self.ec_pump.run(self.current_state.dose_duration)
-                self.current_state.last_dose_time = time.time()
-                self.current_state.dose_count += 1
-                self.current_state.total_dose_time += self.current_state.dose_duration
-                # status_json = self.current_state.status_json()
-                # _LOG.debug("Publishing state: %s", status_json)
-                # self.mqtt_client.publish(
-                #     self.mqtt_topics[ID_STATE], status_json, qos=1, retain=True
-                # )
+    def recent_reading(self, name: str, max_age: float) -> Union[float, None]:
+        """Return the latest reading of a sensor, or None if there isn't a recent one."""
+        if self.current_state.sensors is None:
+            return None
+        sensor = self.current_state.sensors.get(name)
+        if sensor is None:
+            return None
+        latest = sensor.latest()
+        if latest is None or time.time() - latest[0] > max_age:
+            return None
+        return latest[1]
+
+    def latest_temperature(self) -> Union[float, None]:
+        """Return the latest temperature reading, or None if there isn't a recent one."""
+        return self.recent_reading(
+            self.app_config.temperature_sensor, self.app_config.temperature_max_age
+        )
+
+    def latest_ec(self) -> Union[float, None]:
+        """Return the current EC, or None if it is older than ec_max_age.
+
+        Dosing is suspended while the EC is stale, e.g. if mqtt-io or the broker
+        stop delivering readings.
+        """
+        stale = (
+            self.ec_time is None
+            or time.time() - self.ec_time > self.app_config.ec_max_age
+        )
+        if stale != self.ec_stale:
+            self.ec_stale = stale
+            if stale:
+                _LOG.warning(
+                    "No EC reading in the last %s s - dosing suspended",
+                    self.app_config.ec_max_age,
+                )
+            else:
+                _LOG.info("EC readings resumed")
+        return None if stale else self.current_state.current_ec
+
+    def latest_reading(self, name: str) -> Union[float, None]:
+        """Return the current EC or a recent reading of a sensor for the recipe."""
+        if name == SENSOR_EC:
+            return self.latest_ec()
+        return self.recent_reading(name, self.app_config.sensor_max_age)
+
+    def process_ec(self, ec: float):
+        """Compensate an EC reading to 25C and store it in the history.
+
+        With ec_temperature_compensation the reading from mqtt-io is uncompensated and
+        is joined with the latest temperature. Readings are used uncompensated if there
+        is no temperature within temperature_max_age seconds.
+
+        mqtt-io only publishes the EC, so the voltage is recovered using the
+        calibration that was in use when the reading was taken.
+        """
+        calibration_data = self.current_state.calibration_data
+        temperature = None
+        if self.app_config.ec_temperature_compensation:
+            temperature = self.latest_temperature()
+        if temperature is None:
+            _LOG.debug("No recent temperature - EC is not compensated")
+            self.current_state.current_temperature = None
+            temperature = float("nan")
+            compensated_ec = ec
+        else:
+            self.current_state.current_temperature = temperature
+            compensated_ec = ec / (
+                1.0
+                + calibration_data.temperature_coefficient
+                * (temperature - CALIBRATION_TEMPERATURE)
+            )
+        now = time.time()
+        self.current_state.current_ec = compensated_ec
+        self.ec_time = now
+        voltage = calc_voltage(ec, CALIBRATION_TEMPERATURE, calibration_data)
+        self.ec_history.append(now, voltage, temperature, compensated_ec)
+
+    def recipe(self) -> Recipe:
+        """The recipe from the config, or the default single pump recipe."""
+        return self.app_config.recipe or default_recipe(self.app_config.motor_channel)
+
+    def pump(self, channel: int) -> Pump:
+        """Return the pump on a channel with its calibrated flow rate."""
+        if channel not in self.pumps:
+            self.pumps[channel] = Pump(
+                channel,
+                self.current_state.pump_calibration.flow_rate(channel),
+                self.pump_board,
+            )
+        return self.pumps[channel]
+
+    def create_pumps(self):
+        """Create the pumps in the recipe and for manual doses"""
+        channels = pump_channels(self.recipe(), self.app_config.motor_channel)
+        self.pumps = {
+            channel: pump for channel, pump in self.pumps.items() if channel in channels
+        }
+        for channel in channels:
+            self.pump(channel)
+
+    def dose(self, pump_config: PumpConfig, volume: float):
+        """Dose a volume in ml and update the running totals, history and usage
+
+        Called from the scheduler, possibly for several pumps at once.
+        """
+        volume_dosed, run_time = self.pump(pump_config.channel).dose(volume)
+        now = time.time()
+        with self.dose_lock:
+            self.current_state.last_dose_time = now
+            self.current_state.dose_count += 1
+            self.current_state.total_dose_time += run_time
+            self.current_state.total_dose_volume += volume_dosed
+            self.dose_history.append(now, pump_config.channel, run_time, volume_dosed)
+            if self.current_state.usage is not None:
+                self.current_state.usage.record_dose(now, run_time, volume_dosed)
+                write_usage(self.current_state.usage, self.app_config.usage_file)
+
+    def calibrate_pump(self):
+        """Run the pump for flow rate calibration, or calculate the flow rate."""
+        pump_calibration = self.current_state.pump_calibration
+        if pump_calibration.status == PumpCalibrationStatus.RUNNING:
+            # A pump error mustn't stop the controller
+            try:
+                with self.scheduler.reserve(pump_calibration.channel):
+                    pump = self.pump(pump_calibration.channel)
+                    pump_calibration.run_time = pump.run(pump_calibration.duration)
+            except Exception as e:  # pylint: disable=broad-except
+                _LOG.exception("Error running pump %d", pump_calibration.channel)
+                pump_calibration.status = PumpCalibrationStatus.ERROR
+                pump_calibration.message = (
+                    f"Error running pump on channel {pump_calibration.channel}: {e}"
+                )
+                return
+            pump_calibration.status = PumpCalibrationStatus.MEASURING
+            pump_calibration.message = (
+                f"Pump ran for {pump_calibration.run_time:.2f} s - "
+                "enter the volume pumped"
+            )
+        elif (
+            pump_calibration.status == PumpCalibrationStatus.MEASURING
+            and pump_calibration.measured_volume > 0
+        ):
+            pump_calibration.calibrate()
+            write_pump_calibration(
+                pump_calibration, self.app_config.pump_calibration_file
+            )
+            self.pump(pump_calibration.channel).flow_rate = pump_calibration.flow_rate(
+                pump_calibration.channel
+            )
 
     def calibrate_ec(self):
         """Calibrate the EC sensor"""
         _LOG.info("Calibrating EC sensor")
+        previous_calibration = copy.deepcopy(self.current_state.calibration_data)
         try:
             run_calibration(
-                self.current_state.calibration_data, self.app_config.mqttio_config_file
+                self.current_state.calibration_data,
+                self.app_config.mqttio_config_file,
+                self.latest_temperature,
             )
             # self.current_state.calibration_status = calibration_data.status
             # message = calibration_data.message
@@ -203,47 +523,231 @@ class HydroController:
 
         if self.current_state.calibration_data.status == CalibrationStatus.CALIBRATED:
             self.mqttio_controller.restart()
+            self.reprocess_ec_history(previous_calibration)
+
+    def reprocess_ec_history(self, previous_calibration):
+        """Correct the EC readings taken since the previous calibration.
+
+        The probe is assumed to have drifted steadily since it was last calibrated,
+        so the correction is interpolated between the two calibrations.
+        """
+        if previous_calibration.calibration_time < 0:
+            _LOG.info("No previous calibration - EC history not reprocessed")
+            return
+        try:
+            reprocess(
+                self.ec_history,
+                self.current_state.calibration_data,
+                start=previous_calibration.calibration_time,
+                previous_calibration=previous_calibration,
+            )
+        except (IOError, ValueError) as e:
+            _LOG.error("Error reprocessing EC history: %s", e)
 
     def manual_dose(self):
-        """Dose for a given duration"""
-        self.ec_pump.run(self.current_state.manual_dose_duration)
-        self.current_state.last_dose_time = time.time()
-        self.current_state.dose_count += 1
-        self.current_state.total_dose_time += self.current_state.manual_dose_duration
+        """Dose a given volume with the pump on motor_channel"""
+        channel = self.app_config.motor_channel
+        pump_config = next(
+            (p for p in self.recipe().pumps.values() if p.channel == channel),
+            PumpConfig("manual", channel),
+        )
+        self.current_state.manual_dose = False
+        job = DoseJob(
+            pump_config,
+            self.current_state.manual_dose_volume,
+            self.current_state.equilibration_time,
+            "manual",
+        )
+        if not self.scheduler.submit(job):
+            _LOG.warning("Manual dose not made - dose queue is full")
         # status_json = self.current_state.status_json()
         # _LOG.debug("Publishing state following manual dose: %s", status_json)
         # self.mqtt_client.publish(
         #     self.mqtt_topics[ID_STATE], status_json, qos=1, retain=True
         # )
-        self.current_state.manual_dose = False
+
+    def check_config(self):
+        """Apply any changes that have been made to the config file."""
+        if self.config_watcher is None:
+            return
+        changes = self.config_watcher.poll()
+        if not changes:
+            return
+        # A bad edit mustn't stop the controller
+        try:
+            self.apply_config_changes(changes)
+        except Exception as e:  # pylint: disable=broad-except
+            _LOG.exception("Error applying config changes")
+            self.config_watcher.revert(changes, f"Cannot apply changes: {e}")
+
+    def apply_config_changes(self, changes: ConfigChanges):
+        """Apply changes to the configuration in place, rebuilding only what changed."""
+        for name, value in changes.state.items():
+            setattr(self.current_state, name, value)
+        app_changes = changes.app
+        for name, (_, new) in app_changes.items():
+            setattr(self.app_config, name, new)
+
+        if "log_level" in app_changes:
+            logging.getLogger().setLevel(self.app_config.log_level)
+        if "flask_host" in app_changes:
+            _LOG.warning("Changing flask_host requires the app to be restarted")
+
+        if any(name in app_changes for name in MQTT_CONNECTION_FIELDS):
+            self.reconnect_mqtt(app_changes)
+        elif any(name in app_changes for name in SUBSCRIPTION_FIELDS):
+            old_topics = self.subscription_topics()
+            self.mqtt_topics[ID_EC] = self.app_config.ec_prefix
+            self.update_sensor_registry()
+            self.update_subscriptions(old_topics)
+
+        if "pump_calibration_file" in app_changes:
+            self.current_state.pump_calibration = read_pump_calibration(
+                self.app_config.pump_calibration_file
+            )
+            self.current_state.pump_calibration.channel = self.app_config.motor_channel
+            for channel, pump in self.pumps.items():
+                pump.flow_rate = self.current_state.pump_calibration.flow_rate(channel)
+        if "motor_channel" in app_changes or "recipe" in app_changes:
+            self.create_pumps()
+            self.scheduler.set_recipe(self.recipe())
+            _LOG.info("Using pumps on channels %s", sorted(self.pumps))
+        if "ec_history_file" in app_changes:
+            self.ec_history = EcHistory(self.app_config.ec_history_file)
+        if "dose_history_file" in app_changes:
+            self.dose_history = DoseHistory(self.app_config.dose_history_file)
+        if "sensor_history_dir" in app_changes:
+            self.sensor_history = SensorHistory(self.app_config.sensor_history_dir)
+            if self.current_state.sensors is not None:
+                self.current_state.sensors.history = self.sensor_history
+        if "usage_file" in app_changes:
+            self.current_state.usage = read_usage(self.app_config.usage_file)
+        if "ec_calibration_file" in app_changes:
+            self.current_state.calibration_data = read_calibration(
+                self.app_config.ec_calibration_file
+            )
+        if (
+            "ec_temperature_compensation" in app_changes
+            or "mqttio_config_file" in app_changes
+        ):
+            self.check_ec_compensation()
+        if "mqttio_config_file" in app_changes:
+            self.mqttio_controller.stop()
+            self.mqttio_controller = MqttIo(self.app_config.mqttio_config_file)
+            self.mqttio_controller.start()
+
+    def check_ec_compensation(self):
+        """Warn if both mqtt-io and the controller compensate the EC for temperature."""
+        if not self.app_config.ec_temperature_compensation:
+            return
+        try:
+            temperature_sensor = mqttio_temperature_sensor(
+                self.app_config.mqttio_config_file
+            )
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _LOG.debug("Cannot read the mqtt-io EC sensor config: %s", e)
+            return
+        if temperature_sensor:
+            _LOG.warning(
+                "The EC is compensated for temperature twice: mqtt-io uses %s and "
+                "ec_temperature_compensation is on. Remove tempsensor from the EC "
+                "sensor in %s or turn off ec_temperature_compensation.",
+                temperature_sensor,
+                self.app_config.mqttio_config_file,
+            )
+
+    def update_sensor_registry(self):
+        """Rebuild the sensor registry from the mqtt-io config."""
+        self.current_state.sensors = read_sensor_registry(
+            self.app_config.mqttio_config_file, self.app_config.sensor_history_size
+        )
+        self.current_state.sensors.history = self.sensor_history
+
+    def reconnect_mqtt(self, app_changes: dict):
+        """Connect to the MQTT broker with changed connection settings.
+
+        If the new broker cannot be reached we revert to the previous settings.
+        """
+        if self.mqtt_client is not None:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.disconnect()
+            self.mqtt_client = None
+        if any(name in app_changes for name in SUBSCRIPTION_FIELDS):
+            self.update_sensor_registry()
+        try:
+            self.mqtt_client = self.setup_mqtt()
+        except (ConnectionRefusedError, socket.gaierror, OSError) as e:
+            message = (
+                f"Cannot connect to MQTT broker with new settings: {e} - "
+                "keeping previous broker settings"
+            )
+            _LOG.error(message)
+            self.current_state.config_error = message
+            for name in MQTT_CONNECTION_FIELDS + ("ec_prefix",):
+                if name in app_changes:
+                    setattr(self.app_config, name, app_changes[name][0])
+            self.retry_mqtt()
+            return
+        self.mqtt_client.loop_start()
+
+    def retry_mqtt(self):
+        """Connect to the MQTT broker if there is no connection.
+
+        Called by step() until the connection succeeds, e.g. if the previous broker
+        can't be reached either after a failed change of broker.
+        """
+        try:
+            self.mqtt_client = self.setup_mqtt()
+        except (ConnectionRefusedError, socket.gaierror, OSError) as e:
+            self.mqtt_error = f"Cannot connect to MQTT broker: {e} - retrying"
+            _LOG.error(self.mqtt_error)
+            self.current_state.config_error = self.mqtt_error
+            return
+        self.mqtt_client.loop_start()
+        _LOG.info("Connected to MQTT broker %s", self.app_config.mqtt_host)
+        if self.current_state.config_error == self.mqtt_error:
+            self.current_state.config_error = ""
+        self.mqtt_error = ""
 
     def run(self):
         """Run the hydro controller"""
         self.mqtt_client.loop_start()
         self.mqttio_controller.start()
+        self.scheduler.start()
         while True:
-            while not self.mqtt_client.is_connected():
+            while self.mqtt_client is not None and not self.mqtt_client.is_connected():
                 _LOG.warning("mqtt_client not connected")
                 self.mqtt_client.reconnect()
                 time.sleep(2)
 
             if not self.mqttio_controller.running():
                 _LOG.warning("MQTT IO process isn't running!")
-            # _LOG.debug("%s %s", id(self.current_state), self.current_state)
 
-            if (
-                self.current_state.calibration_data.status
-                == CalibrationStatus.CALIBRATING
-            ):
-                self.calibrate_ec()
+            self.step()
+            time.sleep(self.loop_delay)
 
-            if self.current_state.manual_dose:
-                self.manual_dose()
+    def step(self):
+        """Act on any changes to the config or the AppState"""
+        if self.mqtt_client is None:
+            self.retry_mqtt()
+        self.check_config()
+        # _LOG.debug("%s %s", id(self.current_state), self.current_state)
 
-            if self.current_state.control:
-                self.control_ec()
+        if self.current_state.calibration_data.status == CalibrationStatus.CALIBRATING:
+            self.calibrate_ec()
 
-            time.sleep(self.loop_delay)
+        if self.current_state.pump_calibration.status in (
+            PumpCalibrationStatus.RUNNING,
+            PumpCalibrationStatus.MEASURING,
+        ):
+            self.calibrate_pump()
+
+        if self.current_state.manual_dose:
+            self.manual_dose()
+
+        # Without its thread the scheduler doses here, once per loop
+        if not self.scheduler.threaded:
+            self.scheduler.poll()
 
 
 if __name__ == "__main__":
@@ -253,11 +757,13 @@ if __name__ == "__main__":
     CURRENT_STATE = AppState()
     if os.path.isfile(CONFIG_FILE):
         APP_CONFIG, CURRENT_STATE = process_config(CONFIG_FILE)
+    else:
+        CONFIG_FILE = None
 
     logging.basicConfig(
         level=APP_CONFIG.log_level,
         format="%(asctime)s rpi: %(message)s",
     )
 
-    controller = HydroController(APP_CONFIG, CURRENT_STATE)
+    controller = HydroController(APP_CONFIG, CURRENT_STATE, CONFIG_FILE)
     controller.run()
@@ -0,0 +1,42 @@
+"""Record every dose made by the pumps"""
+
+import logging
+from typing import Union
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.record_file import RecordFile
+
+# Fixed size records so the file can be memory mapped and read in chunks
+DOSE_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("channel", "<i2"),
+        ("duration", "<f4"),
+        ("volume", "<f4"),
+    ]
+)
+
+_LOG = logging.getLogger(__name__)
+
+
+class DoseHistory:
+    """Append-only binary file of doses."""
+
+    def __init__(self, history_file: str):
+        self.history_file = history_file
+        self.file = RecordFile(history_file, DOSE_DTYPE)
+
+    def append(
+        self, timestamp: float, channel: int, duration: float, volume: float
+    ) -> None:
+        """Add a dose to the end of the history."""
+        record = np.array([(timestamp, channel, duration, volume)], dtype=DOSE_DTYPE)
+        try:
+            self.file.append(record)
+        except IOError as exc:
+            _LOG.warning("Failed to write dose history: %s", exc)
+
+    def records(self) -> Union[np.memmap, np.ndarray]:
+        """Memory map the complete records currently in the file."""
+        return self.file.records()
@@ -5,12 +5,15 @@ import datetime
 from enum import IntEnum
 import json
 import logging
+import math
 import os
 import statistics
 import sys
 import time
+from typing import Callable, List, Union
 
 
+import numpy as np
 import yaml
 
 from mqtt_io.modules.sensor import dfr0300
@@ -26,6 +29,22 @@ LOW_BUFFER_SOLUTION = 1.413
 HIGH_BUFFER_SOLUTION = 12.88
 RES2 = 820.0
 ECREF = 200.0
+CALIBRATION_VERSION = 2
+TEMPERATURE_COEFFICIENT = 0.0185
+# Raw EC above which kvalue_high is used rather than kvalue_low
+KVALUE_RAW_EC_THRESHOLD = 2.5
+# Bounds on the kvalue implied by a single point, outside which the probe reading
+# doesn't match the stated buffer solution
+KVALUE_MIN = 0.5
+KVALUE_MAX = 2.0
+MAX_CALIBRATION_POINTS = 20
+# Points closer than this in temperature with the same buffer replace each other
+SAME_POINT_TEMPERATURE = 1.0
+# Spread of point temperatures needed to fit the temperature coefficient
+MIN_TEMPERATURE_SPREAD = 5.0
+# Physical range of the temperature coefficient of EC (per C)
+TEMPERATURE_COEFFICIENT_MIN = 0.01
+TEMPERATURE_COEFFICIENT_MAX = 0.03
 
 
 class CalibrationException(Exception):
@@ -58,22 +77,33 @@ class CalibrationPoint:
 
 @dataclasses.dataclass(**({"slots": True} if PY310 else {}))
 class CalibrationData:
-    """Class to handle calibration data"""
+    """Class to handle calibration data
 
+    The kvalues and temperature coefficient are fitted by least squares to all of the
+    calibrated points. The fit statistics are the residuals (fitted EC - buffer EC) for
+    each point used in the fit, their root mean square and the R-squared of the fit.
+    """
+
+    version: int = CALIBRATION_VERSION
     kvalue_low: float = INITIAL_KVALUE
     kvalue_high: float = INITIAL_KVALUE
+    temperature_coefficient: float = TEMPERATURE_COEFFICIENT
     temperature: float = CALIBRATION_TEMPERATURE
+    # Buffer solution for the next calibration, or -1 to detect the standard buffers
+    buffer_solution: float = -1.0
     status: CalibrationStatus = CalibrationStatus.NOT_CALIBRATED
     message: str = "Unknown Status"
-    point_low: CalibrationPoint = dataclasses.field(default_factory=CalibrationPoint)
-    point_high: CalibrationPoint = dataclasses.field(default_factory=CalibrationPoint)
+    points: List[CalibrationPoint] = dataclasses.field(default_factory=list)
+    residuals: List[float] = dataclasses.field(default_factory=list)
+    rmse: float = -1.0
+    r_squared: float = -1.0
 
     def __post_init__(self):
         """https://stackoverflow.com/questions/53376099/python-dataclass-from-a-nested-dict"""
-        if isinstance(self.point_low, dict):
-            self.point_low = CalibrationPoint(**self.point_low)
-        if isinstance(self.point_high, dict):
-            self.point_high = CalibrationPoint(**self.point_high)
+        self.points = [
+            CalibrationPoint(**point) if isinstance(point, dict) else point
+            for point in self.points
+        ]
         if self.calibration_time < 0:
             self.status = CalibrationStatus.NOT_CALIBRATED
             self.message = "Not Calibrated"
@@ -88,24 +118,47 @@ class CalibrationData:
 
     @property
     def calibration_time(self) -> int:
-        """Return the calibration time from the last point calibrated."""
-        time_low = self._calibration_time(self.point_low)
-        time_high = self._calibration_time(self.point_high)
-        if time_low > 0 and time_high > 0:
-            if time_low > time_high:
-                return time_low
-            return time_high
-        return -1
-
-    @staticmethod
-    def _calibration_time(point: CalibrationPoint) -> int:
-        if point and point.status == CalibrationStatus.CALIBRATED:
-            return point.time
-        return -1
+        """Return the time of the last point calibrated, or -1 if there are none.
+
+        A probe used in only one range needs only that range calibrated, the other
+        kvalue keeping its default.
+        """
+        return max(
+            (
+                point.time
+                for point in self.points
+                if point.status == CalibrationStatus.CALIBRATED and point.time > 0
+            ),
+            default=-1,
+        )
 
 
-def parse_config(config_file, module_name="dfr0300"):
-    """Parse MQTT-IO config file for sensor module and sensor input"""
+def is_high_range(point: CalibrationPoint) -> bool:
+    """Whether a point calibrates kvalue_high.
+
+    Points from version 1 calibration files have no voltage so use the buffer solution.
+    """
+    if point.voltage > 0:
+        return calc_raw_ec(point.voltage) > KVALUE_RAW_EC_THRESHOLD
+    return point.buffer_solution > KVALUE_RAW_EC_THRESHOLD
+
+
+def upgrade_calibration(data: dict) -> dict:
+    """Convert calibration data read from an older version of the calibration file."""
+    if data.get("version", 1) == 1:
+        data = dict(data)
+        points = []
+        for key in ("point_low", "point_high"):
+            point = data.pop(key, None)
+            if point and point.get("status") == CalibrationStatus.CALIBRATED:
+                points.append(point)
+        data["points"] = points
+        data["version"] = CALIBRATION_VERSION
+    return data
+
+
+def find_sensor_config(config_file, module_name="dfr0300"):
+    """Find the sensor module and sensor input in an MQTT-IO config file"""
     with open(config_file, "r", encoding="utf8") as stream:
         config = yaml.safe_load(stream)
 
@@ -127,7 +180,12 @@ def parse_config(config_file, module_name="dfr0300"):
             break
     if not sensor_config:
         raise ValueError("Sensor not found")
+    return module_config, sensor_config
+
 
+def parse_config(config_file, module_name="dfr0300"):
+    """Parse MQTT-IO config file for sensor module and sensor input"""
+    module_config, sensor_config = find_sensor_config(config_file, module_name)
     # Remove the temperature sensor config so we don't try and
     # access the event bus
     if dfr0300.TEMPSENSOR_ID in sensor_config:
@@ -136,6 +194,12 @@ def parse_config(config_file, module_name="dfr0300"):
     return module_config, sensor_config
 
 
+def mqttio_temperature_sensor(config_file) -> Union[str, None]:
+    """The temperature sensor mqtt-io compensates the EC with, or None if it doesn't."""
+    _, sensor_config = find_sensor_config(config_file)
+    return sensor_config.get(dfr0300.TEMPSENSOR_ID)
+
+
 def read_calibration(calibration_file) -> CalibrationData:
     """Read calibrated values from json file."""
     if os.path.exists(calibration_file):
@@ -143,7 +207,7 @@ def read_calibration(calibration_file) -> CalibrationData:
             calibration_file, "r", encoding=CALIBRATION_FILE_ENCODING
         ) as file_handle:
             data = json.load(file_handle)
-        return CalibrationData(**data)
+        return CalibrationData(**upgrade_calibration(data))
     else:
         _LOG.warning(
             "Calibration file not found: %s - using defaults.", calibration_file
@@ -164,16 +228,27 @@ def write_calibration(calibration_data, calibration_file) -> None:
         _LOG.warning("Failed to write calibration data: %s", exc)
 
 
-def calc_calibration_voltage_and_temperature(dfr0300_module, temperature):
-    """Calculate calibration voltage and temperature"""
+def calc_calibration_voltage_and_temperature(
+    dfr0300_module,
+    temperature,
+    temperature_source: Union[Callable[[], Union[float, None]], None] = None,
+):
+    """Calculate calibration voltage and temperature
+
+    temperature_source returns the current temperature from the temperature sensor,
+    or None if there isn't a recent reading, in which case temperature is used.
+    """
     num_samples = 20
     sample_interval = 1
     voltages = []
-    temperatures = []  # for when using a temp sensor
+    temperatures = []
     for _ in range(num_samples):
         voltage = dfr0300_module.board.get_adc_value(dfr0300_module.channel)
         voltages.append(voltage)
-        temperatures.append(temperature)
+        sample_temperature = temperature_source() if temperature_source else None
+        temperatures.append(
+            temperature if sample_temperature is None else sample_temperature
+        )
         time.sleep(sample_interval)
 
     _LOG.debug(
@@ -195,66 +270,292 @@ def calc_calibration_voltage_and_temperature(dfr0300_module, temperature):
     return voltage, temperature
 
 
-@staticmethod
 def calc_raw_ec(voltage: float) -> float:
     """Convert voltage to raw EC"""
     return 1000 * voltage / RES2 / ECREF
 
 
-def calibrate(
-    calibration_data: CalibrationData, voltage: float, temperature: float
+def calc_ec(
+    voltage: float, temperature: float, calibration_data: CalibrationData
+) -> float:
+    """Convert a voltage measured at temperature to EC compensated to 25C"""
+    raw_ec = calc_raw_ec(voltage)
+    if raw_ec > KVALUE_RAW_EC_THRESHOLD:
+        kvalue = calibration_data.kvalue_high
+    else:
+        kvalue = calibration_data.kvalue_low
+    return (
+        raw_ec
+        * kvalue
+        / (
+            1.0
+            + calibration_data.temperature_coefficient
+            * (temperature - CALIBRATION_TEMPERATURE)
+        )
+    )
+
+
+def calc_ec_batch(
+    voltages: np.ndarray,
+    temperatures: Union[np.ndarray, float],
+    calibration_data: CalibrationData,
+) -> np.ndarray:
+    """Vectorised calc_ec for arrays of voltages.
+
+    temperatures may be an array of the same shape as voltages or a single value.
+    NaN temperatures (not measured) are taken to be 25C.
+    Returns a new float64 array of EC compensated to 25C.
+    """
+    ec = np.multiply(voltages, 1000.0 / RES2 / ECREF, dtype=np.float64)
+    ec *= np.where(
+        ec > KVALUE_RAW_EC_THRESHOLD,
+        calibration_data.kvalue_high,
+        calibration_data.kvalue_low,
+    )
+    compensation = np.subtract(
+        temperatures, CALIBRATION_TEMPERATURE, dtype=np.float64
+    )
+    compensation *= calibration_data.temperature_coefficient
+    compensation += 1.0
+    ec /= np.nan_to_num(compensation, copy=False, nan=1.0)
+    return ec
+
+
+def calc_voltage(ec: float, temperature: float, calibration_data: CalibrationData) -> float:
+    """Convert EC compensated to 25C back to the voltage it was calculated from
+
+    This is the inverse of calc_ec. A NaN temperature is taken to be 25C.
+    """
+    if math.isnan(temperature):
+        temperature = CALIBRATION_TEMPERATURE
+    uncompensated = ec * (
+        1.0
+        + calibration_data.temperature_coefficient
+        * (temperature - CALIBRATION_TEMPERATURE)
+    )
+    raw_ec = uncompensated / calibration_data.kvalue_low
+    if raw_ec > KVALUE_RAW_EC_THRESHOLD:
+        raw_ec = uncompensated / calibration_data.kvalue_high
+    return raw_ec * RES2 * ECREF / 1000.0
+
+
+def detect_buffer_solution(raw_ec: float) -> Union[float, None]:
+    """Identify which of the standard buffer solutions the probe is in."""
+    if 0.9 < raw_ec < 1.9:
+        return LOW_BUFFER_SOLUTION
+    # elif 9 < raw_ec < 16.8: # original values from DFRobot
+    if 9 < raw_ec < 20:
+        return HIGH_BUFFER_SOLUTION
+    return None
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class CalibrationFit:
+    """Result of fitting the calibration model to a set of points.
+
+    A kvalue is None if there were no points in its range.
+    """
+
+    kvalue_low: Union[float, None]
+    kvalue_high: Union[float, None]
+    temperature_coefficient: float
+    num_points: int
+    residuals: List[float]
+    rmse: float
+    r_squared: float
+
+
+def fit_calibration(
+    points: List[CalibrationPoint],
+    temperature_coefficient: float = TEMPERATURE_COEFFICIENT,
+) -> CalibrationFit:
+    """Least squares fit of the kvalues and temperature coefficient to the points.
+
+    The probe measures the buffer conductivity at the point temperature, which is
+    related to the buffer EC at 25C by the linear temperature model, so for each point:
+
+        kvalue * raw_ec = buffer * (1 + coefficient * (temperature - 25))
+
+    Dividing through by the buffer gives an equation that is linear in the kvalues and
+    the coefficient and weights each point by its relative error. The coefficient is
+    only fitted when the points span enough temperatures and outnumber the parameters,
+    otherwise the supplied coefficient is used. A fitted coefficient outside the
+    physical range is clamped to it and the kvalues refitted with that coefficient.
+    """
+    points = [p for p in points if p.voltage > 0]
+    if not points:
+        raise CalibrationException("No calibration points with voltages to fit")
+    raw_ec = np.array([calc_raw_ec(p.voltage) for p in points])
+    buffers = np.array([p.buffer_solution for p in points])
+    delta_t = np.array([p.temperature for p in points]) - CALIBRATION_TEMPERATURE
+    high = raw_ec > KVALUE_RAW_EC_THRESHOLD
+    has_low = bool(np.any(~high))
+    has_high = bool(np.any(high))
+
+    columns = []
+    if has_low:
+        columns.append(np.where(high, 0.0, raw_ec / buffers))
+    if has_high:
+        columns.append(np.where(high, raw_ec / buffers, 0.0))
+    # The coefficient is one more parameter than the kvalues
+    fit_coefficient = (
+        np.ptp(delta_t) >= MIN_TEMPERATURE_SPREAD and len(points) > len(columns) + 1
+    )
+    if fit_coefficient:
+        solution, *_ = np.linalg.lstsq(
+            np.column_stack(columns + [-delta_t]), np.ones(len(points)), rcond=None
+        )
+        temperature_coefficient = float(solution[-1])
+        if (
+            TEMPERATURE_COEFFICIENT_MIN
+            <= temperature_coefficient
+            <= TEMPERATURE_COEFFICIENT_MAX
+        ):
+            solution = solution[:-1]
+        else:
+            _LOG.warning(
+                "Fitted temperature coefficient %f is outside %s-%s - clamping it",
+                temperature_coefficient,
+                TEMPERATURE_COEFFICIENT_MIN,
+                TEMPERATURE_COEFFICIENT_MAX,
+            )
+            temperature_coefficient = min(
+                max(temperature_coefficient, TEMPERATURE_COEFFICIENT_MIN),
+                TEMPERATURE_COEFFICIENT_MAX,
+            )
+            fit_coefficient = False
+    if not fit_coefficient:
+        target = 1.0 + temperature_coefficient * delta_t
+        solution, *_ = np.linalg.lstsq(np.column_stack(columns), target, rcond=None)
+
+    solution = list(solution)
+    kvalue_low = float(solution.pop(0)) if has_low else None
+    kvalue_high = float(solution.pop(0)) if has_high else None
+
+    kvalues = np.where(high, kvalue_high or 0.0, kvalue_low or 0.0)
+    fitted = kvalues * raw_ec / (1.0 + temperature_coefficient * delta_t)
+    residuals = fitted - buffers
+    ss_res = float(np.sum(residuals**2))
+    ss_tot = float(np.sum((buffers - buffers.mean()) ** 2))
+    return CalibrationFit(
+        kvalue_low=kvalue_low,
+        kvalue_high=kvalue_high,
+        temperature_coefficient=temperature_coefficient,
+        num_points=len(points),
+        residuals=[round(float(r), 4) for r in residuals],
+        rmse=float(np.sqrt(ss_res / len(points))),
+        r_squared=1.0 - ss_res / ss_tot if ss_tot > 0 else -1.0,
+    )
+
+
+def add_calibration_point(
+    calibration_data: CalibrationData, point: CalibrationPoint
 ) -> None:
-    """Calculate the calibration parameters"""
+    """Add a point, replacing any equivalent point and dropping expired ones."""
+    points = [
+        p
+        for p in calibration_data.points
+        if time.time() - p.time <= CALIBRATION_VALID
+        and not (
+            abs(p.buffer_solution - point.buffer_solution) < 1e-6
+            and abs(p.temperature - point.temperature) < SAME_POINT_TEMPERATURE
+        )
+    ]
+    points.append(point)
+    calibration_data.points = points[-MAX_CALIBRATION_POINTS:]
 
-    def calc_kvalue(ec_solution: float, voltage: float, temperature: float) -> float:
-        comp_ec_solution = ec_solution * (1.0 + 0.0185 * (temperature - 25.0))
-        return round(RES2 * ECREF * comp_ec_solution / 1000.0 / voltage, 2)
 
+def calibrate(
+    calibration_data: CalibrationData,
+    voltage: float,
+    temperature: float,
+    buffer_solution: Union[float, None] = None,
+) -> None:
+    """Add a calibration point and refit the calibration parameters
+
+    If buffer_solution isn't given, the standard low or high buffer is detected from
+    the voltage.
+    """
     cd = calibration_data
     cd.status = CalibrationStatus.ERROR
-    cd.message = "Could not determine the calibration solution in use."
+    if not (math.isfinite(voltage) and voltage > 0):
+        cd.message = f"Invalid probe voltage: {voltage} - check the probe is connected"
+        return
     raw_ec = calc_raw_ec(voltage)
     # _LOG.debug("GOT VOLTAGE %f RAW EC: %f",voltage, raw_ec)
-    if 0.9 < raw_ec < 1.9:
-        msg = "Calibration Low Successful"
-        cd.kvalue_low = calc_kvalue(LOW_BUFFER_SOLUTION, voltage, temperature)
-        cd.status = CalibrationStatus.CALIBRATED
-        cd.message = msg
-        cd.point_low.buffer_solution = LOW_BUFFER_SOLUTION
-        cd.point_low.status = CalibrationStatus.CALIBRATED
-        cd.point_low.message = msg
-        cd.point_low.time = time.time()
-        _LOG.info(
-            "Calibration Solution: %fus/cm kvalue_low: %f",
-            cd.point_low.buffer_solution,
-            cd.kvalue_low,
-        )
-    # elif 9 < raw_ec < 16.8: # original values from DFRobot
-    elif 9 < raw_ec < 20:
-        msg = "Calibration High Successful"
-        cd.kvalue_high = calc_kvalue(HIGH_BUFFER_SOLUTION, voltage, temperature)
-        cd.status = CalibrationStatus.CALIBRATED
-        cd.message = msg
-        cd.point_high.buffer_solution = HIGH_BUFFER_SOLUTION
-        cd.point_high.status = CalibrationStatus.CALIBRATED
-        cd.point_high.message = msg
-        cd.point_high.time = time.time()
-        _LOG.info(
-            "Calibration Solution:%fms/cm kvalue_high:%f ",
-            cd.point_high.buffer_solution,
-            cd.kvalue_high,
+    if buffer_solution is None or buffer_solution <= 0:
+        buffer_solution = detect_buffer_solution(raw_ec)
+        if buffer_solution is None:
+            cd.message = "Could not determine the calibration solution in use."
+            return
+    kvalue = (
+        buffer_solution
+        * (1.0 + cd.temperature_coefficient * (temperature - CALIBRATION_TEMPERATURE))
+        / raw_ec
+    )
+    if not KVALUE_MIN < kvalue < KVALUE_MAX:
+        cd.message = (
+            f"Probe reading (raw EC {raw_ec:.3f}) doesn't match "
+            f"buffer solution {buffer_solution}"
         )
-    return
+        return
 
+    point = CalibrationPoint(
+        buffer_solution=buffer_solution,
+        voltage=voltage,
+        temperature=temperature,
+        time=time.time(),
+        status=CalibrationStatus.CALIBRATED,
+    )
+    point_range = "High" if is_high_range(point) else "Low"
+    point.message = f"Calibration {point_range} Successful"
+    add_calibration_point(cd, point)
+    try:
+        fit = fit_calibration(cd.points)
+    except (CalibrationException, np.linalg.LinAlgError) as e:
+        cd.message = f"Could not fit calibration: {e}"
+        return
+
+    if fit.kvalue_low is not None:
+        cd.kvalue_low = round(fit.kvalue_low, 4)
+    if fit.kvalue_high is not None:
+        cd.kvalue_high = round(fit.kvalue_high, 4)
+    cd.temperature_coefficient = round(fit.temperature_coefficient, 5)
+    cd.residuals = fit.residuals
+    cd.rmse = fit.rmse
+    cd.r_squared = fit.r_squared
+    cd.status = CalibrationStatus.CALIBRATED
+    cd.message = (
+        f"{point.message} with {fit.num_points} points (RMSE {fit.rmse:.3f} ms/cm)"
+    )
+    _LOG.info(
+        "Calibration Solution: %fms/cm kvalue_low: %f kvalue_high: %f "
+        "temperature coefficient: %f rmse: %f r_squared: %f",
+        buffer_solution,
+        cd.kvalue_low,
+        cd.kvalue_high,
+        cd.temperature_coefficient,
+        cd.rmse,
+        cd.r_squared,
+    )
+
+
+def run_calibration(
+    calibration_data: CalibrationData,
+    mqttio_config_file: str,
+    temperature_source: Union[Callable[[], Union[float, None]], None] = None,
+) -> None:
+    """Run the calibration process
 
-def run_calibration(calibration_data: CalibrationData, mqttio_config_file: str) -> None:
-    """Run the calibration process"""
+    If given, temperature_source supplies live temperatures while sampling, otherwise
+    the temperature entered for the calibration is used.
+    """
     module_config, sensor_config = parse_config(mqttio_config_file)
     dfr0300_module = _init_module(module_config, "sensor", False)
     dfr0300_module.setup_sensor(sensor_config, None)
     try:
         voltage, temperature = calc_calibration_voltage_and_temperature(
-            dfr0300_module, calibration_data.temperature
+            dfr0300_module, calibration_data.temperature, temperature_source
         )
     except CalibrationException as e:
         _LOG.warning(
@@ -265,7 +566,7 @@ def run_calibration(calibration_data: CalibrationData, mqttio_config_file: str)
         calibration_data.message = e
         return
 
-    calibrate(calibration_data, voltage, temperature)
+    calibrate(calibration_data, voltage, temperature, calibration_data.buffer_solution)
     if calibration_data.status == CalibrationStatus.ERROR:
         _LOG.warning(
             "Buffer solution error when calibrating EC probe: %s", calibration_data
@@ -284,4 +585,4 @@ if __name__ == "__main__":
         _LOG.error("Config file not found: %s", MQTTIO_CONFIG_FILE)
         exit(1)
 
-    run_calibration(MQTTIO_CONFIG_FILE, CALIBRATION_TEMPERATURE)
+    run_calibration(CalibrationData(), MQTTIO_CONFIG_FILE)
@@ -0,0 +1,180 @@
+"""Record EC readings with their probe voltages and recompute them after recalibration"""
+
+from argparse import ArgumentParser
+import datetime
+import json
+import logging
+import time
+from typing import Union
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.ec_calibrator import (
+    CalibrationData,
+    calc_ec_batch,
+    read_calibration,
+)
+from hydrocontrol_ui.hydrocontrol.record_file import RecordFile
+
+# Fixed size records so the file can be memory mapped and processed in chunks.
+# ec is the value as originally read and is never changed so that it can be audited,
+# ec_corrected is the value after any reprocessing.
+HISTORY_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("voltage", "<f4"),
+        ("temperature", "<f4"),
+        ("ec", "<f4"),
+        ("ec_corrected", "<f4"),
+    ]
+)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+AUDIT_FILE_SUFFIX = ".reprocess.log"
+AUDIT_FILE_ENCODING = "ascii"
+
+_LOG = logging.getLogger(__name__)
+
+
+class EcHistory:
+    """Append-only binary file of EC readings."""
+
+    def __init__(self, history_file: str):
+        self.history_file = history_file
+        self.file = RecordFile(history_file, HISTORY_DTYPE)
+
+    def append(
+        self, timestamp: float, voltage: float, temperature: float, ec: float
+    ) -> None:
+        """Add a reading to the end of the history."""
+        record = np.array(
+            [(timestamp, voltage, temperature, ec, ec)], dtype=HISTORY_DTYPE
+        )
+        try:
+            self.file.append(record)
+        except IOError as exc:
+            _LOG.warning("Failed to write EC history: %s", exc)
+
+    def records(self, mode: str = "r") -> Union[np.memmap, np.ndarray]:
+        """Memory map the complete records currently in the file."""
+        return self.file.records(mode)
+
+
+def reprocess(
+    history: EcHistory,
+    calibration_data: CalibrationData,
+    start: Union[float, None] = None,
+    end: Union[float, None] = None,
+    previous_calibration: Union[CalibrationData, None] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> int:
+    """Recompute ec_corrected from the stored voltages for readings between start and end.
+
+    If previous_calibration is given, the probe is assumed to have drifted linearly
+    between the time of the previous calibration and the new one, so the EC is
+    interpolated between the values given by the two calibrations.
+
+    The file is processed in chunks of chunk_size records so memory use is bounded
+    whatever the size of the history. Returns the number of readings recomputed.
+    """
+    start = -np.inf if start is None else start
+    end = np.inf if end is None else end
+    drift_start = drift_end = None
+    if previous_calibration is not None:
+        drift_start = previous_calibration.calibration_time
+        drift_end = calibration_data.calibration_time
+        if drift_start < 0 or drift_end <= drift_start:
+            _LOG.warning("Cannot interpolate drift without both calibration times")
+            drift_start = drift_end = None
+
+    records = history.records(mode="r+")
+    count = 0
+    for offset in range(0, len(records), chunk_size):
+        chunk = records[offset : offset + chunk_size]
+        times = chunk["time"]
+        selected = (times >= start) & (times <= end)
+        if not selected.any():
+            continue
+        voltages = chunk["voltage"][selected]
+        temperatures = chunk["temperature"][selected]
+        ec = calc_ec_batch(voltages, temperatures, calibration_data)
+        if drift_start is not None:
+            old_ec = calc_ec_batch(voltages, temperatures, previous_calibration)
+            weight = np.clip(
+                (times[selected] - drift_start) / (drift_end - drift_start), 0.0, 1.0
+            )
+            ec = old_ec + weight * (ec - old_ec)
+        chunk["ec_corrected"][selected] = ec
+        count += int(selected.sum())
+    if isinstance(records, np.memmap):
+        records.flush()
+    del records
+
+    write_audit(history, calibration_data, start, end, drift_start is not None, count)
+    _LOG.info("Reprocessed %d EC readings in %s", count, history.history_file)
+    return count
+
+
+def write_audit(
+    history: EcHistory,
+    calibration_data: CalibrationData,
+    start: float,
+    end: float,
+    interpolated: bool,
+    count: int,
+) -> None:
+    """Append a record of a reprocessing run to the audit log next to the history."""
+    entry = {
+        "time": time.time(),
+        "start": start if np.isfinite(start) else None,
+        "end": end if np.isfinite(end) else None,
+        "interpolated": interpolated,
+        "count": count,
+        "kvalue_low": calibration_data.kvalue_low,
+        "kvalue_high": calibration_data.kvalue_high,
+        "temperature_coefficient": calibration_data.temperature_coefficient,
+    }
+    try:
+        with open(
+            history.history_file + AUDIT_FILE_SUFFIX, "a", encoding=AUDIT_FILE_ENCODING
+        ) as file_handle:
+            file_handle.write(json.dumps(entry) + "\n")
+    except IOError as exc:
+        _LOG.warning("Failed to write reprocessing audit log: %s", exc)
+
+
+def parse_time(value: str) -> float:
+    """Parse a timestamp given either as seconds since the epoch or in ISO format."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Recompute EC history with a new calibration")
+    parser.add_argument("history_file", help="EC history file")
+    parser.add_argument("calibration_file", help="New EC calibration file")
+    parser.add_argument(
+        "--previous-calibration",
+        help="Calibration file in use before, to interpolate drift between the two",
+    )
+    parser.add_argument("--start", type=parse_time, help="Start time (ISO or epoch)")
+    parser.add_argument("--end", type=parse_time, help="End time (ISO or epoch)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s rpi: %(message)s",
+    )
+    previous = None
+    if args.previous_calibration:
+        previous = read_calibration(args.previous_calibration)
+    reprocess(
+        EcHistory(args.history_file),
+        read_calibration(args.calibration_file),
+        start=args.start,
+        end=args.end,
+        previous_calibration=previous,
+        chunk_size=args.chunk_size,
+    )
@@ -0,0 +1,365 @@
+"""Stream EC, dose and sensor history as CSV or compressed columnar files
+
+Records are read in fixed size chunks and each chunk is converted as a whole, so
+memory use doesn't depend on the size of the export and there is no per-row Python
+work: CSV rows are formatted with a single % operation per chunk and columnar exports
+are written as numpy arrays.
+
+Columnar exports are npz archives (zip files of .npy arrays, readable with numpy.load)
+with each chunk of each column stored as a separate compressed member named
+<column>/<chunk>. read_export() joins them back into whole columns.
+
+Export from the command line with:
+
+    python -m hydrocontrol_ui.hydrocontrol.export -c hydrocontrol.yml ec out.csv
+        [--start 2024-06-01] [--end 2024-07-01] [--resolution 3600] [--format npz]
+
+where the source is ec, doses or the name of an mqtt-io sensor.
+"""
+
+from argparse import ArgumentParser
+import io
+import logging
+import sys
+from typing import Dict, Iterable, Iterator, Tuple, Union
+import zipfile
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.dose_history import DoseHistory
+from hydrocontrol_ui.hydrocontrol.ec_history import EcHistory, parse_time
+from hydrocontrol_ui.hydrocontrol.sensor_history import (
+    RESERVED_SENSOR_NAMES,
+    SensorHistory,
+)
+from hydrocontrol_ui.hydrocontrol.state_classes import load_config
+
+EXPORT_CHUNK_SIZE = 16 * 1024
+FORMAT_CSV = "csv"
+FORMAT_NPZ = "npz"
+FORMATS = (FORMAT_CSV, FORMAT_NPZ)
+FORMAT_MIMETYPES = {FORMAT_CSV: "text/csv", FORMAT_NPZ: "application/zip"}
+# Sources of the EC and dose histories, which sensor histories can't be named
+SOURCE_EC, SOURCE_DOSES = RESERVED_SENSOR_NAMES
+MEAN = "mean"
+SUM = "sum"
+# How each field is aggregated when downsampling, fields not listed are dropped
+EC_AGGREGATION = {
+    "voltage": MEAN,
+    "temperature": MEAN,
+    "ec": MEAN,
+    "ec_corrected": MEAN,
+}
+# Doses on all channels are totalled
+DOSE_AGGREGATION = {"duration": SUM, "volume": SUM}
+SENSOR_AGGREGATION = {"value": MEAN}
+# CSV format by numpy dtype kind
+CSV_FORMATS = {"f": "%.6g", "i": "%d", "u": "%d", "b": "%d"}
+CSV_TIME_FORMAT = "%.3f"
+
+_LOG = logging.getLogger(__name__)
+
+
+def history_chunks(
+    records: np.ndarray,
+    start: Union[float, None] = None,
+    end: Union[float, None] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    in_order: bool = True,
+) -> Iterator[np.ndarray]:
+    """Yield copies of the records with start <= time < end, chunk_size at a time.
+
+    Records are appended in time order, so the range is normally found by binary search
+    and only the chunks exported are read from a memory mapped file. If the clock was
+    stepped back while recording, in_order is False (see RecordFile.in_order) and a
+    binary search would miss records, so every chunk is filtered instead. Records are
+    always exported in the order they were recorded.
+    """
+    times = records["time"]
+    if start is None and end is None:
+        first, last = 0, len(records)
+    elif in_order:
+        first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+        last = (
+            len(records) if end is None else int(np.searchsorted(times, end, side="left"))
+        )
+    else:
+        _LOG.warning("History times are out of order - filtering all records")
+        yield from _filtered_chunks(records, start, end, chunk_size)
+        return
+    for chunk_start in range(first, last, chunk_size):
+        yield np.array(records[chunk_start : min(chunk_start + chunk_size, last)])
+
+
+def _filtered_chunks(
+    records: np.ndarray,
+    start: Union[float, None],
+    end: Union[float, None],
+    chunk_size: int,
+) -> Iterator[np.ndarray]:
+    for chunk_start in range(0, len(records), chunk_size):
+        chunk = records[chunk_start : chunk_start + chunk_size]
+        selected = np.ones(len(chunk), dtype=bool)
+        if start is not None:
+            selected &= chunk["time"] >= start
+        if end is not None:
+            selected &= chunk["time"] < end
+        if selected.any():
+            yield np.array(chunk[selected])
+
+
+def downsampled_dtype(aggregation: Dict[str, str]) -> np.dtype:
+    """The dtype of downsampled records."""
+    return np.dtype(
+        [("time", "<f8"), ("count", "<u4")]
+        + [(name, "<f8") for name in aggregation]
+    )
+
+
+def downsample(
+    chunks: Iterable[np.ndarray], resolution: float, aggregation: Dict[str, str]
+) -> Iterator[np.ndarray]:
+    """Aggregate chunks of records into periods of resolution seconds.
+
+    Each output record has the start time of the period, the number of records in it
+    and each field in aggregation as the mean (ignoring NaNs) or sum of its values.
+    Records in the same period may span chunks, so the last period of each chunk is
+    held back until the next one starts.
+    """
+    dtype = downsampled_dtype(aggregation)
+    pending = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        periods = np.floor(chunk["time"] / resolution).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+        groups = {
+            "period": periods[starts],
+            "count": np.diff(np.r_[starts, len(chunk)]),
+        }
+        for name in aggregation:
+            values = chunk[name].astype(np.float64)
+            finite = np.isfinite(values)
+            groups[name] = np.add.reduceat(np.where(finite, values, 0.0), starts)
+            groups[f"{name}:n"] = np.add.reduceat(finite.astype(np.int64), starts)
+        if pending is not None:
+            if pending["period"][0] == groups["period"][0]:
+                for key, value in pending.items():
+                    if key != "period":
+                        groups[key][0] += value[0]
+            else:
+                groups = {
+                    key: np.concatenate((pending[key], value))
+                    for key, value in groups.items()
+                }
+        pending = {key: value[-1:] for key, value in groups.items()}
+        if len(groups["period"]) > 1:
+            yield _aggregate(groups, slice(0, -1), resolution, aggregation, dtype)
+    if pending is not None:
+        yield _aggregate(pending, slice(None), resolution, aggregation, dtype)
+
+
+def _aggregate(
+    groups: Dict[str, np.ndarray],
+    index: slice,
+    resolution: float,
+    aggregation: Dict[str, str],
+    dtype: np.dtype,
+) -> np.ndarray:
+    records = np.empty(len(groups["period"][index]), dtype=dtype)
+    records["time"] = groups["period"][index] * resolution
+    records["count"] = groups["count"][index]
+    for name, how in aggregation.items():
+        if how == SUM:
+            records[name] = groups[name][index]
+        else:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                records[name] = groups[name][index] / groups[f"{name}:n"][index]
+    return records
+
+
+def csv_rows(chunks: Iterable[np.ndarray], dtype: np.dtype) -> Iterator[str]:
+    """Yield a header line and then each chunk of records as CSV rows."""
+    names = dtype.names
+    yield ",".join(names) + "\n"
+    row_format = (
+        ",".join(
+            CSV_TIME_FORMAT if name == "time" else CSV_FORMATS[dtype[name].kind]
+            for name in names
+        )
+        + "\n"
+    )
+    for chunk in chunks:
+        count = len(chunk)
+        if count == 0:
+            continue
+        # Interleave the columns into one flat list of values
+        values = [None] * (count * len(names))
+        for i, name in enumerate(names):
+            values[i :: len(names)] = chunk[name].tolist()
+        yield (row_format * count) % tuple(values)
+
+
+class _StreamBuffer:
+    """Write-only file from which the data written so far can be taken."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        """Remove and return the data written so far."""
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def npz_chunks(chunks: Iterable[np.ndarray], dtype: np.dtype) -> Iterator[bytes]:
+    """Yield an npz archive of the records as it is written, one chunk at a time."""
+    stream = _StreamBuffer()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        index = 0
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            _write_npz_chunk(archive, chunk, index)
+            index += 1
+            yield stream.take()
+        if index == 0:
+            # Store empty columns so that the archive still describes the fields
+            _write_npz_chunk(archive, np.empty(0, dtype=dtype), 0)
+    yield stream.take()
+
+
+def _write_npz_chunk(archive: zipfile.ZipFile, chunk: np.ndarray, index: int) -> None:
+    for name in chunk.dtype.names:
+        buffer = io.BytesIO()
+        np.lib.format.write_array(
+            buffer, np.ascontiguousarray(chunk[name]), allow_pickle=False
+        )
+        archive.writestr(f"{name}/{index:06d}.npy", buffer.getvalue())
+
+
+def read_export(npz_file) -> Dict[str, np.ndarray]:
+    """Read a columnar export, joining the chunks of each column."""
+    columns = {}
+    with np.load(npz_file) as archive:
+        for key in sorted(archive.files):
+            name = key.rsplit("/", 1)[0]
+            columns.setdefault(name, []).append(archive[key])
+    return {name: np.concatenate(chunks) for name, chunks in columns.items()}
+
+
+def export(
+    chunks: Iterable[np.ndarray],
+    dtype: np.dtype,
+    aggregation: Dict[str, str],
+    export_format: str = FORMAT_CSV,
+    resolution: Union[float, None] = None,
+) -> Iterator[Union[str, bytes]]:
+    """Convert chunks of records to an export format, downsampling if resolution is set.
+
+    Raises ValueError for an unknown format.
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if resolution:
+        chunks = downsample(chunks, resolution, aggregation)
+        dtype = downsampled_dtype(aggregation)
+    if export_format == FORMAT_NPZ:
+        return npz_chunks(chunks, dtype)
+    return csv_rows(chunks, dtype)
+
+
+def export_history(
+    source: str,
+    ec_history: EcHistory,
+    dose_history: DoseHistory,
+    start: Union[float, None] = None,
+    end: Union[float, None] = None,
+    export_format: str = FORMAT_CSV,
+    resolution: Union[float, None] = None,
+    sensor_history: Union[SensorHistory, None] = None,
+) -> Iterator[Union[str, bytes]]:
+    """Export the EC or dose history, or the history of a sensor.
+
+    Raises ValueError for an unknown source or format.
+    """
+    if source == SOURCE_EC:
+        record_file, aggregation = ec_history.file, EC_AGGREGATION
+    elif source == SOURCE_DOSES:
+        record_file, aggregation = dose_history.file, DOSE_AGGREGATION
+    elif sensor_history is not None and source in sensor_history.names():
+        record_file = sensor_history.record_file(source)
+        aggregation = SENSOR_AGGREGATION
+    else:
+        raise ValueError(f"Unknown export source: {source}")
+    records = record_file.records()
+    return export(
+        history_chunks(records, start, end, in_order=record_file.in_order()),
+        records.dtype,
+        aggregation,
+        export_format,
+        resolution,
+    )
+
+
+def parse_export_args(
+    start: Union[str, None], end: Union[str, None], resolution: Union[str, None]
+) -> Tuple[Union[float, None], Union[float, None], Union[float, None]]:
+    """Parse the time range and resolution of an export.
+
+    Raises ValueError if they are invalid.
+    """
+    start = None if not start else parse_time(start)
+    end = None if not end else parse_time(end)
+    resolution = None if not resolution else float(resolution)
+    if resolution is not None and not resolution > 0:
+        raise ValueError(f"Invalid resolution: {resolution}")
+    return start, end, resolution
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export the EC, dose or sensor history")
+    parser.add_argument(
+        "-c", "--config", required=True, help="Path to the config file"
+    )
+    parser.add_argument(
+        "source", help=f"{SOURCE_EC}, {SOURCE_DOSES} or the name of a sensor"
+    )
+    parser.add_argument("output_file", help="File to write, - for stdout")
+    parser.add_argument("--format", choices=FORMATS, default=FORMAT_CSV)
+    parser.add_argument("--start", help="Start time (ISO or epoch)")
+    parser.add_argument("--end", help="End time (ISO or epoch)")
+    parser.add_argument("--resolution", help="Seconds to aggregate records over")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s rpi: %(message)s",
+    )
+    app_config, _ = load_config(args.config)
+    start, end, resolution = parse_export_args(args.start, args.end, args.resolution)
+    parts = export_history(
+        args.source,
+        EcHistory(app_config.ec_history_file),
+        DoseHistory(app_config.dose_history_file),
+        start,
+        end,
+        args.format,
+        resolution,
+        SensorHistory(app_config.sensor_history_dir),
+    )
+    if args.output_file == "-":
+        output = sys.stdout.buffer
+    else:
+        output = open(args.output_file, "wb")  # pylint: disable=consider-using-with
+    with output:
+        for part in parts:
+            output.write(part.encode("ascii") if isinstance(part, str) else part)
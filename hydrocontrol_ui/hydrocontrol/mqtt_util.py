@@ -2,6 +2,7 @@
 
 import logging
 import json
+import math
 from typing import Callable, List
 
 from hydrocontrol_ui.hydrocontrol.state_classes import AppConfig, AppState
@@ -20,6 +21,7 @@ ID_STATE = "state"
 ID_LAST_DOSE_TIME = "last_dose_time"
 ID_DOSE_COUNT = "dose_count"
 ID_TOTAL_DOSE_TIME = "total_dose_time"
+ID_TOTAL_DOSE_VOLUME = "total_dose_volume"
 
 
 def setup_mqtt_topics(app_config: AppConfig) -> dict[str, str]:
@@ -43,8 +45,8 @@ def create_on_connect(
     """Create a callback to handle connection to MQTT broker."""
 
     # @mqtt.on_connect()
-    def on_mqtt_connect(client, _userdata, _flags, _reason_code):
-        # def on_connect(client, _userdata, _flags, _reason_code, _properties):
+    def on_mqtt_connect(client, _userdata, _flags, _reason_code, _properties=None):
+        # Accepts both the paho VERSION1 and VERSION2 callback signatures
         """Subscribe to topics on connect."""
         retcodes = []
         subscribed = []
@@ -61,8 +63,10 @@ def create_on_connect(
         # Not sure how to call the decorator when it's an object method
         # on_mqtt_connect = flask_decorator(on_mqtt_connect)
         @flask_decorator()
-        def decorated_on_mqtt_connect(client, _userdata, _flags, _reason_code):
-            return on_mqtt_connect(client, _userdata, _flags, _reason_code)
+        def decorated_on_mqtt_connect(
+            client, _userdata, _flags, _reason_code, _properties=None
+        ):
+            return on_mqtt_connect(client, _userdata, _flags, _reason_code, _properties)
 
     if flask_decorator:
         return decorated_on_mqtt_connect
@@ -99,15 +103,18 @@ def create_on_message(
                 state.current_ec = -1.0
         elif topic == mqtt_topics[ID_MANUAL_DOSE]:
             try:
-                state.manual_dose_duration = int(payload)
+                volume = float(payload)
+                if not (math.isfinite(volume) and volume > 0):
+                    raise ValueError("volume must be a positive number")
+                state.manual_dose_volume = volume
             except ValueError as e:
-                _LOG.warning("Error getting manual dose duration: %s - %s", payload, e)
+                _LOG.warning("Error getting manual dose volume: %s - %s", payload, e)
                 state.manual_dose = False
-                state.manual_dose_duration = 0
+                state.manual_dose_volume = 0.0
                 return
             state.manual_dose = True
         elif topic == mqtt_topics[ID_PARAMETERS]:
-            variables = ["dose_duration", "equilibration_time", "target_ec"]
+            variables = ["dose_volume", "equilibration_time", "target_ec"]
             process_variables(payload, state, variables)
         elif topic == mqtt_topics[ID_STATE]:
             variables = [
@@ -115,6 +122,7 @@ def create_on_message(
                 "dose_count",
                 "last_dose_time",
                 "total_dose_time",
+                "total_dose_volume",
             ]
             process_variables(payload, state, variables)
 
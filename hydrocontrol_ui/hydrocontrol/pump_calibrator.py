@@ -0,0 +1,128 @@
+"""Calibrate the flow rate of the peristaltic dosing pumps"""
+
+import dataclasses
+from enum import IntEnum
+import json
+import logging
+import math
+import os
+import sys
+from typing import Dict
+
+PY310 = sys.version_info >= (3, 10)
+CALIBRATION_FILE_ENCODING = "ascii"
+# With the default flow rate a dose of x ml runs the pump for x seconds
+DEFAULT_FLOW_RATE = 1.0  # ml/s
+DEFAULT_CALIBRATION_DURATION = 30.0  # s
+
+_LOG = logging.getLogger(__name__)
+
+
+def valid_flow_rate(flow_rate) -> bool:
+    """Whether a flow rate is a finite number of ml/s greater than zero."""
+    return (
+        isinstance(flow_rate, (int, float))
+        and not isinstance(flow_rate, bool)
+        and math.isfinite(flow_rate)
+        and flow_rate > 0
+    )
+
+
+class PumpCalibrationStatus(IntEnum):
+    """Enum for the stages of calibrating a pump."""
+
+    NOT_CALIBRATED = 0
+    RUNNING = 1  # Requested to run the pump for duration seconds
+    MEASURING = 2  # Waiting for the volume pumped to be measured
+    CALIBRATED = 3
+    ERROR = 4
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class PumpCalibration:
+    """Flow rates of the pumps in ml/s, by channel.
+
+    To calibrate, the pump on channel is run for duration seconds (status RUNNING).
+    run_time is then set to how long it actually ran and the volume it pumped is
+    measured and stored in measured_volume (status MEASURING), from which the flow rate
+    is calculated.
+    """
+
+    flow_rates: Dict[int, float] = dataclasses.field(default_factory=dict)
+    channel: int = 0
+    duration: float = DEFAULT_CALIBRATION_DURATION
+    run_time: float = 0.0
+    measured_volume: float = 0.0
+    status: PumpCalibrationStatus = PumpCalibrationStatus.NOT_CALIBRATED
+    message: str = "Not Calibrated"
+
+    def __post_init__(self):
+        # json stores the channel keys as strings
+        flow_rates = {}
+        for channel, flow_rate in self.flow_rates.items():
+            if valid_flow_rate(flow_rate):
+                flow_rates[int(channel)] = float(flow_rate)
+            else:
+                _LOG.warning(
+                    "Ignoring invalid flow rate for channel %s: %r", channel, flow_rate
+                )
+        self.flow_rates = flow_rates
+        if self.flow_rates:
+            self.status = PumpCalibrationStatus.CALIBRATED
+            self.message = f"Flow rates (ml/s): {self.flow_rates}"
+
+    def flow_rate(self, channel: int) -> float:
+        """Return the flow rate for a channel, or the default if it isn't calibrated."""
+        return self.flow_rates.get(channel, DEFAULT_FLOW_RATE)
+
+    def calibrate(self) -> None:
+        """Calculate the flow rate from the measured volume."""
+        if self.run_time <= 0 or self.measured_volume <= 0:
+            self.status = PumpCalibrationStatus.ERROR
+            self.message = "Pump must be run and the volume measured before calibrating"
+            return
+        flow_rate = self.measured_volume / self.run_time
+        if not valid_flow_rate(round(flow_rate, 4)):
+            self.status = PumpCalibrationStatus.ERROR
+            self.message = (
+                f"Invalid flow rate {flow_rate} ml/s from {self.measured_volume} ml "
+                f"in {self.run_time:.2f} s"
+            )
+            self.measured_volume = 0.0
+            _LOG.warning(self.message)
+            return
+        self.flow_rates[self.channel] = round(flow_rate, 4)
+        self.status = PumpCalibrationStatus.CALIBRATED
+        self.message = (
+            f"Channel {self.channel} flow rate {flow_rate:.3f} ml/s "
+            f"({self.measured_volume} ml in {self.run_time:.2f} s)"
+        )
+        self.measured_volume = 0.0
+        _LOG.info(self.message)
+
+
+def read_pump_calibration(calibration_file: str) -> PumpCalibration:
+    """Read pump flow rates from json file."""
+    if not os.path.exists(calibration_file):
+        _LOG.warning(
+            "Pump calibration file not found: %s - using %s ml/s.",
+            calibration_file,
+            DEFAULT_FLOW_RATE,
+        )
+        return PumpCalibration()
+    with open(calibration_file, "r", encoding=CALIBRATION_FILE_ENCODING) as file_handle:
+        data = json.load(file_handle)
+    return PumpCalibration(flow_rates=data.get("flow_rates", {}))
+
+
+def write_pump_calibration(
+    pump_calibration: PumpCalibration, calibration_file: str
+) -> None:
+    """Write pump flow rates to json file."""
+    try:
+        with open(
+            calibration_file, "w", encoding=CALIBRATION_FILE_ENCODING
+        ) as file_handle:
+            json.dump({"flow_rates": pump_calibration.flow_rates}, file_handle, indent=2)
+    except IOError as exc:
+        _LOG.warning("Failed to write pump calibration data: %s", exc)
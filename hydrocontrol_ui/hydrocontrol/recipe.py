@@ -0,0 +1,153 @@
+"""Pumps and dosing recipes declared in the config file"""
+
+import dataclasses
+import sys
+from typing import Dict, List, Union
+
+PY310 = sys.version_info >= (3, 10)
+DEFAULT_RESERVOIR = "main"
+SENSOR_EC = "ec"  # The temperature compensated EC rather than a sensor in the registry
+DEFAULT_PUMP = "ec"
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class PumpConfig:
+    """A pump on a motor channel, dosing into a reservoir."""
+
+    name: str
+    channel: int
+    reservoir: str = DEFAULT_RESERVOIR
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class RecipeStep:
+    """A correction dosed when a reading is below or above a threshold.
+
+    Each pump in doses gives volume ml times its ratio, e.g. {nutrient_a: 1,
+    nutrient_b: 1} doses volume ml of each. For the EC with no threshold the step
+    doses when it is below target_ec. volume defaults to the dose_volume and
+    mixing_time, the wait after dosing before the reservoir is dosed again, to the
+    equilibration_time.
+    """
+
+    name: str
+    doses: Dict[str, float]
+    sensor: str = SENSOR_EC
+    below: Union[float, None] = None
+    above: Union[float, None] = None
+    volume: Union[float, None] = None
+    mixing_time: Union[float, None] = None
+
+    def triggered(self, value: float, target_ec: float) -> bool:
+        """Whether a reading needs correcting."""
+        if self.below is not None:
+            return value < self.below
+        if self.above is not None:
+            return value > self.above
+        return self.sensor == SENSOR_EC and value < target_ec
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class Recipe:
+    """The pumps by name and the steps of the recipe, in order of priority.
+
+    Only the first step that is triggered in a reservoir is dosed, so e.g. pH is only
+    corrected once the EC is on target.
+    """
+
+    pumps: Dict[str, PumpConfig]
+    steps: List[RecipeStep]
+
+    def reservoir(self, step: RecipeStep) -> str:
+        """The reservoir that a step doses into."""
+        return self.pumps[next(iter(step.doses))].reservoir
+
+    def reservoirs(self) -> List[str]:
+        """All the reservoirs dosed into."""
+        return list(dict.fromkeys(pump.reservoir for pump in self.pumps.values()))
+
+
+def default_recipe(motor_channel: int) -> Recipe:
+    """A single pump on motor_channel dosing whenever the EC is below target."""
+    return Recipe(
+        pumps={DEFAULT_PUMP: PumpConfig(DEFAULT_PUMP, motor_channel)},
+        steps=[RecipeStep(DEFAULT_PUMP, {DEFAULT_PUMP: 1.0})],
+    )
+
+
+def pump_channels(recipe: Union[Recipe, None], motor_channel: int) -> List[int]:
+    """The channels with pumps: those in the recipe and motor_channel for manual doses."""
+    channels = {motor_channel}
+    if recipe is not None:
+        channels.update(pump.channel for pump in recipe.pumps.values())
+    return sorted(channels)
+
+
+def _number(value, description: str, minimum: float = 0.0) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum:
+        raise ValueError(f"Invalid {description}: {value!r}")
+    return float(value)
+
+
+def parse_recipe(pumps_config, recipe_config) -> Union[Recipe, None]:
+    """Create a Recipe from the pumps and recipe sections of the config file.
+
+    Returns None if neither section is present, for the default recipe. Raises
+    ValueError if they are invalid.
+    """
+    if pumps_config is None and recipe_config is None:
+        return None
+    if not isinstance(pumps_config, dict) or not pumps_config:
+        raise ValueError("'pumps' must map pump names to their channel and reservoir")
+    if not isinstance(recipe_config, list) or not recipe_config:
+        raise ValueError("'recipe' must be a list of steps")
+
+    pumps = {}
+    channels = {}
+    for name, pump_config in pumps_config.items():
+        try:
+            pump = PumpConfig(str(name), **(pump_config or {}))
+        except TypeError as e:
+            raise ValueError(f"Invalid pump '{name}': {e}") from e
+        if isinstance(pump.channel, bool) or not isinstance(pump.channel, int):
+            raise ValueError(f"Invalid channel for pump '{name}': {pump.channel!r}")
+        if pump.channel in channels:
+            raise ValueError(
+                f"Pumps '{channels[pump.channel]}' and '{name}' are both on "
+                f"channel {pump.channel}"
+            )
+        channels[pump.channel] = name
+        pump.reservoir = str(pump.reservoir)
+        pumps[pump.name] = pump
+
+    steps = []
+    for step_config in recipe_config:
+        try:
+            step = RecipeStep(**(step_config or {}))
+        except TypeError as e:
+            raise ValueError(f"Invalid recipe step {step_config}: {e}") from e
+        if not isinstance(step.doses, dict) or not step.doses:
+            raise ValueError(f"Recipe step '{step.name}' must have doses")
+        for pump_name, ratio in step.doses.items():
+            if pump_name not in pumps:
+                raise ValueError(f"Unknown pump '{pump_name}' in step '{step.name}'")
+            step.doses[pump_name] = _number(ratio, f"ratio for pump '{pump_name}'")
+        if len({pumps[p].reservoir for p in step.doses}) > 1:
+            raise ValueError(f"Pumps in step '{step.name}' dose different reservoirs")
+        if step.below is not None and step.above is not None:
+            raise ValueError(f"Step '{step.name}' can't have both 'below' and 'above'")
+        if step.sensor != SENSOR_EC and step.below is None and step.above is None:
+            raise ValueError(f"Step '{step.name}' needs a 'below' or 'above' threshold")
+        for field in ("below", "above"):
+            if getattr(step, field) is not None:
+                setattr(
+                    step, field, _number(getattr(step, field), field, -float("inf"))
+                )
+        if step.volume is not None:
+            step.volume = _number(step.volume, f"volume for step '{step.name}'")
+        if step.mixing_time is not None:
+            step.mixing_time = _number(
+                step.mixing_time, f"mixing_time for step '{step.name}'"
+            )
+        steps.append(step)
+    return Recipe(pumps, steps)
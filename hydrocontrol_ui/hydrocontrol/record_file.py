@@ -0,0 +1,98 @@
+"""Append-only files of fixed size records that can be memory mapped"""
+
+import logging
+import os
+import threading
+from typing import Union
+
+import numpy as np
+
+# Marks a file with times that go backwards, if the clock was stepped back
+UNORDERED_FILE_SUFFIX = ".unordered"
+
+_LOG = logging.getLogger(__name__)
+
+
+class RecordFile:
+    """Binary file of records of a numpy dtype, appended to by a single process.
+
+    The dtype must have a time field. A crash part way through an append leaves a
+    partial record, which would misalign every record appended after it, so the first
+    append drops any partial record from the end of the file. This is checked again
+    after a failed write. Appends also check that the times never go backwards, and
+    if they do a marker file is created so readers know the file can't be searched.
+    """
+
+    def __init__(self, path: str, dtype: np.dtype):
+        self.path = path
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self._aligned = False
+        self._last_time = None  # Time of the last record in the file
+
+    def append(self, records: np.ndarray) -> None:
+        """Add records of dtype to the end of the file, raising OSError on failure."""
+        with self.lock:
+            try:
+                if not self._aligned:
+                    self._truncate_partial_record()
+                    self._last_time = self._read_last_time()
+                    self._aligned = True
+                times = records["time"]
+                if len(times) and (
+                    (self._last_time is not None and times[0] < self._last_time)
+                    or np.any(times[1:] < times[:-1])
+                ):
+                    self._mark_unordered()
+                with open(self.path, "ab") as file_handle:
+                    file_handle.write(records.astype(self.dtype, copy=False).tobytes())
+                if len(times):
+                    self._last_time = times[-1]
+            except OSError:
+                self._aligned = False
+                raise
+
+    def in_order(self) -> bool:
+        """Whether the times of the records never go backwards."""
+        return not os.path.exists(self.path + UNORDERED_FILE_SUFFIX)
+
+    def records(self, mode: str = "r") -> Union[np.memmap, np.ndarray]:
+        """Memory map the complete records currently in the file."""
+        if not os.path.exists(self.path):
+            return np.empty(0, dtype=self.dtype)
+        count = os.path.getsize(self.path) // self.dtype.itemsize
+        if count == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=(count,))
+
+    def _truncate_partial_record(self) -> None:
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        partial = size % self.dtype.itemsize
+        if partial:
+            _LOG.warning(
+                "Dropping %d bytes of a partial record from the end of %s",
+                partial,
+                self.path,
+            )
+            os.truncate(self.path, size - partial)
+
+    def _read_last_time(self) -> Union[float, None]:
+        try:
+            with open(self.path, "rb") as file_handle:
+                file_handle.seek(0, os.SEEK_END)
+                if file_handle.tell() < self.dtype.itemsize:
+                    return None
+                file_handle.seek(-self.dtype.itemsize, os.SEEK_END)
+                record = np.frombuffer(file_handle.read(), dtype=self.dtype)
+        except FileNotFoundError:
+            return None
+        return record["time"][0]
+
+    def _mark_unordered(self) -> None:
+        if self.in_order():
+            _LOG.warning("Times in %s have gone backwards", self.path)
+            with open(self.path + UNORDERED_FILE_SUFFIX, "w", encoding="ascii"):
+                pass
@@ -0,0 +1,492 @@
+"""Record MQTT traffic and replay it into the controller under a virtual clock
+
+A recording is a gzip stream of messages, each stored as a fixed size header (the
+time it was received, its flags and the lengths of its topic and payload) followed by
+the topic and payload bytes.
+
+Recordings are replayed through a LocalTransport, so no broker is needed, and with
+the time module of the controller and the modules it uses replaced by a VirtualClock.
+Time then only passes when the code sleeps or the next message is due, so a replay is
+deterministic and can run in real time, accelerated or as fast as possible.
+
+Record from a broker and replay with:
+
+    python -m hydrocontrol_ui.hydrocontrol.replay record FILE [--host HOST] [--topic T]
+    python -m hydrocontrol_ui.hydrocontrol.replay replay FILE -c hydrocontrol.yml
+        [--speed 1000] [--set target_ec=1.6] [--output-dir DIR] [--handlers]
+"""
+
+from argparse import ArgumentParser
+import contextlib
+import dataclasses
+import gzip
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Iterable, Iterator, Sequence, Tuple, Union
+
+import paho.mqtt.client as mqtt
+
+from hydrocontrol_ui.hydrocontrol import (
+    config_watcher,
+    controller,
+    ec_calibrator,
+    ec_history,
+    mqtt_util,
+    scheduler,
+    sensors,
+    usage,
+)
+from hydrocontrol_ui.hydrocontrol.record_file import UNORDERED_FILE_SUFFIX
+from hydrocontrol_ui.hydrocontrol.state_classes import (
+    AppConfig,
+    AppState,
+    process_config,
+)
+from hydrocontrol_ui.hydrocontrol.transport import (
+    TRANSPORT_LOCAL,
+    LocalTransport,
+    Message,
+)
+from hydrocontrol_ui.hydrocontrol.usage import UsageRollups
+
+PY310 = sys.version_info >= (3, 10)
+RECORDING_MAGIC = b"HCREC\x01"
+# Time received, flags, topic length, payload length
+RECORD_HEADER = struct.Struct("<dBHI")
+RETAIN_FLAG = 0x01
+# Modules whose time module is replaced by the VirtualClock during a replay
+CLOCK_MODULES = (
+    config_watcher,
+    controller,
+    ec_calibrator,
+    ec_history,
+    scheduler,
+    sensors,
+    usage,
+)
+# mqtt_util commands that are applied to the AppState when replaying into the controller
+REPLAYED_COMMANDS = (
+    mqtt_util.ID_CONTROL,
+    mqtt_util.ID_MANUAL_DOSE,
+    mqtt_util.ID_PARAMETERS,
+)
+
+_LOG = logging.getLogger(__name__)
+
+
+class Recorder:
+    """Writes messages to a recording file.
+
+    on_message can be used directly as a paho or LocalTransport callback.
+    """
+
+    def __init__(self, recording_file: str):
+        self.file = gzip.open(recording_file, "wb")
+        self.file.write(RECORDING_MAGIC)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(
+        self, timestamp: float, topic: str, payload: bytes, retain: bool = False
+    ) -> None:
+        """Append a message to the recording."""
+        topic_bytes = topic.encode("utf-8")
+        header = RECORD_HEADER.pack(
+            timestamp, RETAIN_FLAG if retain else 0, len(topic_bytes), len(payload)
+        )
+        with self.lock:
+            self.file.write(header + topic_bytes + payload)
+            self.count += 1
+
+    def on_message(self, _client, _userdata, message) -> None:
+        """Record a message as it is received."""
+        self.record(time.time(), message.topic, message.payload, message.retain)
+
+    def close(self) -> None:
+        """Flush and close the recording."""
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_recording(recording_file: str) -> Iterator[Tuple[float, Message]]:
+    """Yield the time each message in a recording was received and the message.
+
+    Raises ValueError if the file isn't a recording. A record truncated by the
+    recorder being killed ends the recording.
+    """
+    with gzip.open(recording_file, "rb") as file_handle:
+        if file_handle.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"Not a recording file: {recording_file}")
+        while True:
+            header = file_handle.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, flags, topic_length, payload_length = RECORD_HEADER.unpack(
+                header
+            )
+            data = file_handle.read(topic_length + payload_length)
+            if len(data) < topic_length + payload_length:
+                _LOG.warning("Recording %s is truncated", recording_file)
+                return
+            topic = data[:topic_length].decode("utf-8")
+            yield timestamp, Message(
+                topic, data[topic_length:], retain=bool(flags & RETAIN_FLAG)
+            )
+
+
+def record(
+    recording_file: str,
+    host: str,
+    port: int,
+    username: str = None,
+    password: str = None,
+    topics: Sequence[str] = ("#",),
+    duration: Union[float, None] = None,
+) -> int:
+    """Record the messages on topics from a broker and return how many were recorded.
+
+    Records for duration seconds, or until interrupted.
+    """
+    with Recorder(recording_file) as recorder:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.username_pw_set(username, password)
+
+        def on_connect(client, _userdata, _flags, _reason_code, _properties=None):
+            for topic in topics:
+                client.subscribe(topic)
+            _LOG.info("Recording topics %s to %s", list(topics), recording_file)
+
+        client.on_connect = on_connect
+        client.on_message = recorder.on_message
+        client.connect(host, port=port)
+        client.loop_start()
+        try:
+            if duration is None:
+                threading.Event().wait()
+            else:
+                time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.disconnect()
+            client.loop_stop()
+    _LOG.info("Recorded %d messages", recorder.count)
+    return recorder.count
+
+
+class VirtualClock:
+    """Stand-in for the time module in which time only passes when slept.
+
+    time(), monotonic() and perf_counter() all return the virtual time. With speed set,
+    sleeps are paced so that virtual time runs at speed times real time; without it
+    they return immediately. Anything else is taken from the time module.
+    """
+
+    def __init__(self, start: float, speed: Union[float, None] = None):
+        self.start = start
+        self.now = start
+        self.speed = speed
+        self._real_start = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self) -> float:
+        """The virtual time as seconds since the epoch."""
+        return self.now
+
+    monotonic = time
+    perf_counter = time
+
+    def sleep(self, seconds: float) -> None:
+        """Advance the virtual time, waiting in real time if paced."""
+        if seconds > 0:
+            self.now += seconds
+        if self.speed:
+            delay = (
+                self._real_start
+                + (self.now - self.start) / self.speed
+                - time.perf_counter()
+            )
+            if delay > 0:
+                time.sleep(delay)
+
+    def advance_to(self, timestamp: float) -> None:
+        """Sleep until timestamp if it is in the future."""
+        if timestamp > self.now:
+            self.sleep(timestamp - self.now)
+
+
+@contextlib.contextmanager
+def virtual_time(clock: VirtualClock, modules: Iterable[ModuleType] = CLOCK_MODULES):
+    """Replace the time module of each module with clock while in the context."""
+    saved = [(module, module.time) for module in modules]
+    for module, _ in saved:
+        module.time = clock
+    try:
+        yield clock
+    finally:
+        for module, real_time in saved:
+            module.time = real_time
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class ReplayStats:
+    """Summary of a replay."""
+
+    messages: int = 0
+    steps: int = 0
+    virtual_seconds: float = 0.0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def message_rate(self) -> float:
+        """Messages handled per second of real time."""
+        return self.messages / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+
+def replay_messages(
+    messages: Iterable[Tuple[float, Message]],
+    transport: LocalTransport,
+    clock: VirtualClock,
+    step: Union[Callable[[], None], None] = None,
+    step_interval: float = 0.0,
+) -> ReplayStats:
+    """Deliver messages to the subscribers of transport at the times they were recorded.
+
+    If given, step is called every step_interval seconds of virtual time between the
+    messages, as the controller loop is. Messages due while a step is sleeping (e.g.
+    during a dose) are delivered as soon as it returns.
+    """
+    stats = ReplayStats()
+    start = clock.time()
+    real_start = time.perf_counter()
+    transport.loop()  # connect and subscribe
+    next_step = clock.time()
+    for timestamp, message in messages:
+        while step is not None and next_step <= timestamp:
+            clock.advance_to(next_step)
+            step()
+            stats.steps += 1
+            next_step = clock.time() + step_interval
+        clock.advance_to(timestamp)
+        transport.deliver(message)
+        stats.messages += transport.loop()
+    stats.virtual_seconds = clock.time() - start
+    stats.elapsed_seconds = time.perf_counter() - real_start
+    return stats
+
+
+def first_timestamp(recording_file: str) -> float:
+    """The time the first message in a recording was received, or now if it's empty."""
+    for timestamp, _ in read_recording(recording_file):
+        return timestamp
+    return time.time()
+
+
+def replay_config(app_config: AppConfig, output_dir: str) -> AppConfig:
+    """A copy of app_config for a replay that uses no broker and writes to output_dir."""
+    return dataclasses.replace(
+        app_config,
+        mqtt_transport=TRANSPORT_LOCAL,
+        mqtt_bridge=False,
+        ec_history_file=os.path.join(output_dir, "ec-history.bin"),
+        dose_history_file=os.path.join(output_dir, "dose-history.bin"),
+        sensor_history_dir=os.path.join(output_dir, "sensor-history"),
+        usage_file=os.path.join(output_dir, "usage.json"),
+    )
+
+
+def replay_controller(
+    recording_file: str,
+    app_config: AppConfig,
+    app_state: AppState,
+    speed: Union[float, None] = None,
+) -> ReplayStats:
+    """Replay a recording into a HydroController with mock pumps.
+
+    app_config should come from replay_config(). The controller handles the messages on
+    its own topics and control, manual dose and parameter commands are applied to
+    app_state with the mqtt_util handlers, as the views would.
+    """
+    clock = VirtualClock(first_timestamp(recording_file), speed)
+    with virtual_time(clock):
+        # No doses have been made before the recording
+        app_state.last_dose_time = clock.time() - app_state.equilibration_time
+        hydro_controller = controller.HydroController(
+            app_config, app_state, mock_pumps=True
+        )
+        transport = hydro_controller.mqtt_client
+        topics = mqtt_util.setup_mqtt_topics(app_config)
+        command_topics = {topics[name] for name in REPLAYED_COMMANDS}
+        on_command = mqtt_util.create_on_message(app_state, topics)
+        on_controller_message = transport.on_message
+
+        def on_message(client, userdata, message):
+            if message.topic in command_topics:
+                on_command(client, userdata, message)
+            else:
+                on_controller_message(client, userdata, message)
+
+        transport.on_message = on_message
+        for topic in command_topics:
+            transport.subscribe(topic)
+        return replay_messages(
+            read_recording(recording_file),
+            transport,
+            clock,
+            step=hydro_controller.step,
+            step_interval=hydro_controller.loop_delay,
+        )
+
+
+def replay_handlers(
+    recording_file: str,
+    app_config: AppConfig,
+    app_state: AppState,
+    speed: Union[float, None] = None,
+) -> ReplayStats:
+    """Replay a recording into the mqtt_util handlers used by the remote UI."""
+    clock = VirtualClock(first_timestamp(recording_file), speed)
+    topics = mqtt_util.setup_mqtt_topics(app_config)
+    transport = LocalTransport()
+    transport.on_connect = mqtt_util.create_on_connect(list(topics), topics)
+    transport.on_message = mqtt_util.create_on_message(app_state, topics)
+    transport.connect()
+    with virtual_time(clock):
+        return replay_messages(read_recording(recording_file), transport, clock)
+
+
+def set_state_variable(app_state: AppState, assignment: str) -> None:
+    """Set an AppState variable from a NAME=VALUE string, converting to its type.
+
+    Raises ValueError if the string is invalid.
+    """
+    name, sep, value = assignment.partition("=")
+    if not sep or name not in {f.name for f in dataclasses.fields(AppState)}:
+        raise ValueError(f"Invalid state variable assignment: {assignment}")
+    current = getattr(app_state, name)
+    if isinstance(current, bool):
+        setattr(app_state, name, value.lower() in ("1", "true", "yes", "on"))
+    elif isinstance(current, (int, float, str)):
+        setattr(app_state, name, type(current)(value))
+    else:
+        raise ValueError(f"Cannot set state variable: {name}")
+
+
+def main():
+    parser = ArgumentParser(description="Record and replay MQTT traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Record from a broker")
+    record_parser.add_argument("recording_file", help="File to record to")
+    record_parser.add_argument("--host", default="localhost")
+    record_parser.add_argument("--port", type=int, default=1883)
+    record_parser.add_argument("--username")
+    record_parser.add_argument("--password")
+    record_parser.add_argument(
+        "--topic", dest="topics", action="append", help="Topic to record (default #)"
+    )
+    record_parser.add_argument("--duration", type=float, help="Seconds to record for")
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a recording")
+    replay_parser.add_argument("recording_file", help="File to replay")
+    replay_parser.add_argument(
+        "-c", "--config", required=True, help="Path to the config file"
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        help="Virtual seconds per real second (default as fast as possible)",
+    )
+    replay_parser.add_argument(
+        "--set",
+        dest="assignments",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Set a state variable before replaying, e.g. target_ec=1.6",
+    )
+    replay_parser.add_argument(
+        "--output-dir",
+        help="Directory for the EC and dose history and usage (default a temp dir)",
+    )
+    replay_parser.add_argument(
+        "--handlers",
+        action="store_true",
+        help="Replay into the mqtt_util handlers instead of the controller",
+    )
+    replay_parser.add_argument("--state-file", help="Write the final state to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s rpi: %(message)s",
+    )
+    if args.command == "record":
+        record(
+            args.recording_file,
+            args.host,
+            args.port,
+            args.username,
+            args.password,
+            args.topics or ["#"],
+            args.duration,
+        )
+        return
+
+    app_config, app_state = process_config(args.config)
+    app_state.usage = UsageRollups()
+    for assignment in args.assignments:
+        set_state_variable(app_state, assignment)
+    with contextlib.ExitStack() as stack:
+        output_dir = args.output_dir or stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+        app_config = replay_config(app_config, output_dir)
+        # Outputs of any earlier replay into output_dir, which would be appended to
+        for file_name in (
+            app_config.ec_history_file,
+            app_config.ec_history_file + UNORDERED_FILE_SUFFIX,
+            app_config.dose_history_file,
+            app_config.dose_history_file + UNORDERED_FILE_SUFFIX,
+            app_config.usage_file,
+        ):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        shutil.rmtree(app_config.sensor_history_dir, ignore_errors=True)
+        replay = replay_handlers if args.handlers else replay_controller
+        stats = replay(args.recording_file, app_config, app_state, args.speed)
+
+    _LOG.info(
+        "Replayed %d messages (%.0f s) in %.3f s: %.0f messages/s, %d control steps",
+        stats.messages,
+        stats.virtual_seconds,
+        stats.elapsed_seconds,
+        stats.message_rate,
+        stats.steps,
+    )
+    status = app_state.status_dict()
+    if args.state_file:
+        with open(args.state_file, "w", encoding="utf-8") as file_handle:
+            json.dump(status, file_handle, indent=2)
+    else:
+        print(json.dumps(status, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Schedule the doses of a recipe across the pumps"""
+
+import collections
+import contextlib
+import dataclasses
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Deque, Dict, List, Set, Union
+
+from hydrocontrol_ui.hydrocontrol.recipe import PumpConfig, Recipe, RecipeStep
+from hydrocontrol_ui.hydrocontrol.state_classes import AppState
+
+PY310 = sys.version_info >= (3, 10)
+DOSE_QUEUE_SIZE = 32
+# Longest time between checks of the readings if no new readings are notified
+SCHEDULER_INTERVAL = 1.0
+
+_LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class DoseJob:
+    """A dose waiting to run or running."""
+
+    pump: PumpConfig
+    volume: float  # ml
+    mixing_time: float  # s to wait after the dose before dosing the reservoir again
+    step: str = ""
+
+
+class DoseScheduler:
+    """Plans the doses of a recipe and runs them, several pumps at a time.
+
+    Every reservoir is checked against the recipe whenever it isn't dosing or mixing.
+    The doses of the first step that is needed are queued and run as soon as their pump
+    channel is free, so doses on different channels run at the same time. Once all the
+    doses into a reservoir have finished it is left to mix for the longest of their
+    mixing times.
+
+    With start() this runs on its own thread, woken by notify() when there are new
+    readings. Otherwise poll() plans and runs the doses in the calling thread.
+    """
+
+    def __init__(
+        self,
+        recipe: Recipe,
+        state: AppState,
+        dose: Callable[[PumpConfig, float], None],
+        read_sensor: Callable[[str], Union[float, None]],
+        queue_size: int = DOSE_QUEUE_SIZE,
+    ):
+        self.recipe = recipe
+        self.state = state
+        self.dose = dose
+        self.read_sensor = read_sensor
+        self.queue_size = queue_size
+        self._queue: Deque[DoseJob] = collections.deque()
+        self._busy_channels: Set[int] = set()
+        self._outstanding: Dict[str, int] = collections.defaultdict(int)
+        self._mixing_time: Dict[str, float] = collections.defaultdict(float)
+        self._mixed_at: Dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Union[threading.Thread, None] = None
+        self._workers: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Run the scheduler on its own thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the scheduler thread and wait for any running doses to finish."""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    @property
+    def threaded(self) -> bool:
+        """Whether the scheduler is running on its own thread."""
+        return self._running
+
+    def notify(self) -> None:
+        """Wake the scheduler to check new readings."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def set_recipe(self, recipe: Recipe) -> None:
+        """Use a new recipe, dropping any doses queued for the old one."""
+        with self._condition:
+            for job in self._queue:
+                self._finish(job)
+            self._queue.clear()
+            self.recipe = recipe
+            self._condition.notify_all()
+
+    def hold(self, seconds: float) -> None:
+        """Leave every reservoir to mix for seconds before dosing it."""
+        until = time.monotonic() + seconds
+        with self._condition:
+            for reservoir in self.recipe.reservoirs():
+                self._mixed_at[reservoir] = max(self._mixed_at.get(reservoir, 0), until)
+
+    def submit(self, job: DoseJob) -> bool:
+        """Queue a dose outside the recipe, returning False if the queue is full."""
+        with self._condition:
+            if not self._enqueue([job]):
+                return False
+            self._condition.notify_all()
+        if not self.threaded:
+            self.poll()
+        return True
+
+    @contextlib.contextmanager
+    def reserve(self, channel: int):
+        """Wait for a channel to be free and keep the scheduler off it in the context."""
+        with self._condition:
+            while channel in self._busy_channels:
+                self._condition.wait()
+            self._busy_channels.add(channel)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._busy_channels.discard(channel)
+                self._condition.notify_all()
+
+    def poll(self) -> None:
+        """Queue any doses that are needed and start those whose pumps are free."""
+        with self._condition:
+            self._plan(time.monotonic())
+            jobs = self._next_jobs()
+        if self.threaded:
+            for job in jobs:
+                worker = threading.Thread(target=self._run_job, args=(job,), daemon=True)
+                try:
+                    worker.start()
+                except RuntimeError:
+                    _LOG.exception("Cannot start a thread to dose %s", job)
+                    self._release(job)
+                    continue
+                self._workers.append(worker)
+            self._workers = [w for w in self._workers if w.is_alive()]
+        else:
+            while jobs:
+                for job in jobs:
+                    self._run_job(job)
+                with self._condition:
+                    jobs = self._next_jobs()
+
+    def _plan(self, now: float) -> None:
+        if not self.state.control:
+            return
+        checked = set()
+        for step in self.recipe.steps:
+            reservoir = self.recipe.reservoir(step)
+            if (
+                reservoir in checked
+                or self._outstanding[reservoir]
+                or now < self._mixed_at.get(reservoir, 0)
+            ):
+                continue
+            # A failing sensor or step mustn't stop the rest of the recipe, but the lower
+            # priority steps in its reservoir wait until it can be checked
+            try:
+                value = self.read_sensor(step.sensor)
+                triggered = value is not None and step.triggered(
+                    value, self.state.target_ec
+                )
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception("Error checking step %s", step.name)
+                checked.add(reservoir)
+                continue
+            if value is None:
+                _LOG.debug("Step %s: no reading from %s", step.name, step.sensor)
+                checked.add(reservoir)
+                continue
+            if not triggered:
+                continue
+            checked.add(reservoir)
+            self._enqueue(self._step_jobs(step, value))
+
+    def _step_jobs(self, step: RecipeStep, value: float) -> List[DoseJob]:
+        """The doses for a step whose reading needs correcting."""
+        volume = self.state.dose_volume if step.volume is None else step.volume
+        mixing_time = step.mixing_time
+        if mixing_time is None:
+            mixing_time = self.state.equilibration_time
+        _LOG.info("Step %s: %s is %s", step.name, step.sensor, value)
+        return [
+            DoseJob(self.recipe.pumps[name], volume * ratio, mixing_time, step.name)
+            for name, ratio in step.doses.items()
+            if ratio > 0
+        ]
+
+    def _enqueue(self, jobs: List[DoseJob]) -> bool:
+        if len(self._queue) + len(jobs) > self.queue_size:
+            _LOG.warning("Dose queue full - dropping doses: %s", jobs)
+            return False
+        for job in jobs:
+            self._outstanding[job.pump.reservoir] += 1
+            self._queue.append(job)
+        return True
+
+    def _next_jobs(self) -> List[DoseJob]:
+        """Take the queued jobs whose channels are free, marking them busy."""
+        jobs = []
+        for job in list(self._queue):
+            if job.pump.channel not in self._busy_channels:
+                self._queue.remove(job)
+                self._busy_channels.add(job.pump.channel)
+                jobs.append(job)
+        return jobs
+
+    def _run_job(self, job: DoseJob) -> None:
+        try:
+            self.dose(job.pump, job.volume)
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception("Error dosing %s", job)
+        finally:
+            self._release(job)
+
+    def _release(self, job: DoseJob) -> None:
+        """Free the channel of a job that has finished or could not run."""
+        with self._condition:
+            self._busy_channels.discard(job.pump.channel)
+            self._finish(job)
+            self._condition.notify_all()
+
+    def _finish(self, job: DoseJob) -> None:
+        reservoir = job.pump.reservoir
+        self._outstanding[reservoir] -= 1
+        self._mixing_time[reservoir] = max(self._mixing_time[reservoir], job.mixing_time)
+        if self._outstanding[reservoir] == 0:
+            self._mixed_at[reservoir] = time.monotonic() + self._mixing_time.pop(
+                reservoir
+            )
+
+    def _timeout(self) -> float:
+        """Time until the next reservoir has mixed, or the scheduler interval."""
+        now = time.monotonic()
+        pending = [t - now for t in self._mixed_at.values() if t > now]
+        return min([SCHEDULER_INTERVAL] + pending)
+
+    def _run_forever(self) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception("Error in dose scheduler")
+            with self._condition:
+                if not self._running:
+                    return
+                self._condition.wait(timeout=self._timeout())
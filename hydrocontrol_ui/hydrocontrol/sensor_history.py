@@ -0,0 +1,78 @@
+"""Record the readings of the mqtt-io sensors"""
+
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Union
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.record_file import RecordFile
+
+# Fixed size records so the files can be memory mapped and read in chunks.
+# Digital inputs are stored as 0 or 1.
+SENSOR_DTYPE = np.dtype([("time", "<f8"), ("value", "<f4")])
+SENSOR_FILE_SUFFIX = ".bin"
+# Sensor names are used as file names
+SENSOR_NAME_PATTERN = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*")
+# The EC and dose histories are exported under these names, and the EC is already
+# recorded with its voltage in the EC history, so sensors with them aren't recorded
+RESERVED_SENSOR_NAMES = ("ec", "doses")
+
+_LOG = logging.getLogger(__name__)
+
+
+class SensorHistory:
+    """Append-only binary file of readings for each sensor, in history_dir."""
+
+    def __init__(self, history_dir: str):
+        self.history_dir = history_dir
+        self.lock = threading.Lock()
+        self.files: Dict[str, RecordFile] = {}
+
+    def history_file(self, name: str) -> str:
+        """The file holding the readings of a sensor.
+
+        Raises ValueError if the name can't be used as a file name.
+        """
+        if not SENSOR_NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid sensor name: {name}")
+        return os.path.join(self.history_dir, name + SENSOR_FILE_SUFFIX)
+
+    def record_file(self, name: str) -> RecordFile:
+        """The RecordFile of a sensor, raising ValueError for an invalid name."""
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = RecordFile(self.history_file(name), SENSOR_DTYPE)
+            return self.files[name]
+
+    def append(self, name: str, timestamp: float, value: Union[float, bool]) -> None:
+        """Add a reading to the end of the history of a sensor."""
+        if name in RESERVED_SENSOR_NAMES:
+            return
+        record = np.array([(timestamp, value)], dtype=SENSOR_DTYPE)
+        try:
+            record_file = self.record_file(name)
+            os.makedirs(self.history_dir, exist_ok=True)
+            record_file.append(record)
+        except (IOError, ValueError) as exc:
+            _LOG.warning("Failed to write sensor history for %s: %s", name, exc)
+
+    def names(self) -> List[str]:
+        """The sensors that have a history."""
+        if not os.path.isdir(self.history_dir):
+            return []
+        return sorted(
+            file_name[: -len(SENSOR_FILE_SUFFIX)]
+            for file_name in os.listdir(self.history_dir)
+            if file_name.endswith(SENSOR_FILE_SUFFIX)
+            and file_name[: -len(SENSOR_FILE_SUFFIX)] not in RESERVED_SENSOR_NAMES
+        )
+
+    def records(self, name: str) -> Union[np.memmap, np.ndarray]:
+        """Memory map the complete records currently in the file of a sensor.
+
+        Raises ValueError for an invalid sensor name.
+        """
+        return self.record_file(name).records()
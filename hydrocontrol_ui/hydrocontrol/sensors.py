@@ -0,0 +1,191 @@
+"""Registry of the sensors published by mqtt-io, with a bounded history of readings"""
+
+import logging
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import yaml
+
+SENSOR_HISTORY_SIZE = 4096
+MQTTIO_TOPIC_PREFIX = "mqtt-io"  # mqtt-io default
+SENSOR_TYPE = "sensor"
+INPUT_TYPE = "input"
+
+_LOG = logging.getLogger(__name__)
+
+
+class SensorBuffer:
+    """Preallocated ring buffer of timestamped readings for a single sensor.
+
+    Sensor inputs are stored as float32 and digital inputs as bool, with float64
+    timestamps in a separate array. Adding a reading is O(1) and never allocates.
+    Raises ValueError if size is less than 1.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        topic: str,
+        sensor_type: str = SENSOR_TYPE,
+        size: int = SENSOR_HISTORY_SIZE,
+        on_payload: str = "ON",
+        off_payload: str = "OFF",
+    ):
+        if size < 1:
+            raise ValueError(f"Invalid history size for sensor {name}: {size}")
+        self.name = name
+        self.topic = topic
+        self.sensor_type = sensor_type
+        self.size = size
+        self.on_payload = on_payload
+        self.off_payload = off_payload
+        dtype = np.bool_ if sensor_type == INPUT_TYPE else np.float32
+        self.times = np.zeros(size, dtype=np.float64)
+        self.values = np.zeros(size, dtype=dtype)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def parse(self, payload: str) -> Union[float, bool]:
+        """Convert a payload to a value, raising ValueError if it is invalid."""
+        if self.sensor_type == INPUT_TYPE:
+            if payload == self.on_payload:
+                return True
+            if payload == self.off_payload:
+                return False
+            raise ValueError(f"Unknown payload for input {self.name}: {payload}")
+        return float(payload)
+
+    def add(self, timestamp: float, value: Union[float, bool]) -> None:
+        """Add a reading, overwriting the oldest once the buffer is full."""
+        with self.lock:
+            index = self.count % self.size
+            self.times[index] = timestamp
+            self.values[index] = value
+            self.count += 1
+
+    def latest(self) -> Union[Tuple[float, Union[float, bool]], None]:
+        """Return the time and value of the latest reading, or None if there isn't one."""
+        with self.lock:
+            if self.count == 0:
+                return None
+            index = (self.count - 1) % self.size
+            return float(self.times[index]), self.values[index].item()
+
+    def series(
+        self, since: Union[float, None] = None, limit: Union[int, None] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Copies of the timestamps and values held, oldest first.
+
+        Only readings after since are returned, and at most the latest limit of those.
+        """
+        with self.lock:
+            held = min(self.count, self.size)
+            start = self.count - held
+            order = np.arange(start, self.count) % self.size
+            times = self.times[order]
+            values = self.values[order]
+        if since is not None:
+            after = times > since
+            times, values = times[after], values[after]
+        if limit is not None and limit >= 0:
+            times, values = times[len(times) - limit :], values[len(values) - limit :]
+        return times, values
+
+    def status_dict(self) -> Dict:
+        """Return a description of the sensor and its latest reading."""
+        latest = self.latest()
+        return {
+            "topic": self.topic,
+            "type": self.sensor_type,
+            "count": self.count,
+            "time": latest[0] if latest else None,
+            "value": latest[1] if latest else None,
+        }
+
+
+class SensorRegistry:
+    """All of the sensors, looked up by name or by the MQTT topic they're published on."""
+
+    def __init__(self, sensors: List[SensorBuffer]):
+        self.by_name = {sensor.name: sensor for sensor in sensors}
+        self.by_topic = {sensor.topic: sensor for sensor in sensors}
+        # Readings are also appended to a SensorHistory if one is set
+        self.history = None
+
+    @property
+    def topics(self) -> List[str]:
+        """The topics of all the sensors."""
+        return list(self.by_topic)
+
+    def get(self, name: str) -> Union[SensorBuffer, None]:
+        """Return the sensor with the given name, or None."""
+        return self.by_name.get(name)
+
+    def handle(self, topic: str, payload: str, timestamp: float = None) -> bool:
+        """Store a message if it is for a sensor and return whether it was."""
+        sensor = self.by_topic.get(topic)
+        if sensor is None:
+            return False
+        try:
+            value = sensor.parse(payload)
+        except ValueError as e:
+            _LOG.warning("Error reading sensor %s: %s - %s", sensor.name, payload, e)
+            return True
+        timestamp = time.time() if timestamp is None else timestamp
+        sensor.add(timestamp, value)
+        if self.history is not None:
+            self.history.append(sensor.name, timestamp, value)
+        return True
+
+    def status_dict(self) -> Dict[str, Dict]:
+        """Return the description and latest reading of every sensor."""
+        return {name: sensor.status_dict() for name, sensor in self.by_name.items()}
+
+
+def read_sensor_registry(
+    mqttio_config_file: str, size: int = SENSOR_HISTORY_SIZE
+) -> SensorRegistry:
+    """Create a registry of the sensor and digital inputs in an mqtt-io config file.
+
+    Raises ValueError if the file cannot be read.
+    """
+    try:
+        with open(mqttio_config_file, "r", encoding="utf8") as stream:
+            config = yaml.safe_load(stream)
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f"Cannot read mqtt-io config {mqttio_config_file}: {e}") from e
+    if not isinstance(config, dict):
+        raise ValueError(f"Invalid mqtt-io config {mqttio_config_file}")
+
+    prefix = (config.get("mqtt") or {}).get("topic_prefix", MQTTIO_TOPIC_PREFIX)
+    sensors = []
+    for sensor_config in config.get("sensor_inputs") or []:
+        name = _input_name(sensor_config, "sensor_inputs", mqttio_config_file)
+        sensors.append(
+            SensorBuffer(name, f"{prefix}/{SENSOR_TYPE}/{name}", SENSOR_TYPE, size)
+        )
+    for input_config in config.get("digital_inputs") or []:
+        name = _input_name(input_config, "digital_inputs", mqttio_config_file)
+        sensors.append(
+            SensorBuffer(
+                name,
+                f"{prefix}/{INPUT_TYPE}/{name}",
+                INPUT_TYPE,
+                size,
+                on_payload=input_config.get("on_payload", "ON"),
+                off_payload=input_config.get("off_payload", "OFF"),
+            )
+        )
+    _LOG.debug("Sensor registry: %s", [sensor.topic for sensor in sensors])
+    return SensorRegistry(sensors)
+
+
+def _input_name(input_config, section: str, mqttio_config_file: str) -> str:
+    """The name of an mqtt-io input, raising ValueError if it hasn't got one."""
+    if not isinstance(input_config, dict) or not input_config.get("name"):
+        raise ValueError(
+            f"Entry in {section} of mqtt-io config {mqttio_config_file} has no name"
+        )
+    return str(input_config["name"])
@@ -2,6 +2,7 @@
 
 import logging
 import json
+import math
 import time
 import dataclasses
 import sys
@@ -12,25 +13,133 @@ from hydrocontrol_ui.hydrocontrol.ec_calibrator import (
     CalibrationData,
     read_calibration,
 )
+from hydrocontrol_ui.hydrocontrol.pump_calibrator import (
+    DEFAULT_FLOW_RATE,
+    PumpCalibration,
+    read_pump_calibration,
+)
+from hydrocontrol_ui.hydrocontrol.recipe import Recipe, parse_recipe
+from hydrocontrol_ui.hydrocontrol.sensors import (
+    SENSOR_HISTORY_SIZE,
+    SensorRegistry,
+    read_sensor_registry,
+)
+from hydrocontrol_ui.hydrocontrol.transport import TRANSPORT_MQTT, TRANSPORTS
+from hydrocontrol_ui.hydrocontrol.usage import UsageRollups, read_usage
 
 _LOG = logging.getLogger()
 
 PY310 = sys.version_info >= (3, 10)
+# AppState fields that hold shared runtime objects and are not part of the status
+STATUS_EXCLUDED_FIELDS = ("usage", "sensors")
+
+
+def load_config(file_path):
+    """Load and validate the configuration file without reading any calibration data.
+
+    Raises ValueError with a description of the problem if the file is invalid.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        try:
+            yamls = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Cannot parse config file {file_path}: {e}") from e
+    if not isinstance(yamls, dict) or "app" not in yamls or "state" not in yamls:
+        raise ValueError("Config file must contain 'app' and 'state' sections")
+
+    values = {section: dict(yamls[section] or {}) for section in ("app", "state")}
+    dose_duration = values["state"].pop("dose_duration", None)
+
+    sections = {}
+    for section, klass in (("app", AppConfig), ("state", AppState)):
+        try:
+            sections[section] = klass(**values[section])
+        except TypeError as e:
+            raise ValueError(f"Invalid '{section}' section: {e}") from e
+        _check_field_types(sections[section], section)
+    _app_config = sections["app"]
+    _current_state = sections["state"]
+    _app_config.recipe = parse_recipe(yamls.get("pumps"), yamls.get("recipe"))
+    if dose_duration is not None:
+        _migrate_dose_duration(
+            _app_config, _current_state, dose_duration, "dose_volume" in values["state"]
+        )
+
+    if not (math.isfinite(_current_state.dose_volume) and _current_state.dose_volume > 0):
+        raise ValueError(
+            f"Invalid value for 'state.dose_volume': {_current_state.dose_volume!r}"
+        )
+
+    if _app_config.sensor_history_size < 1:
+        raise ValueError(
+            "Invalid value for 'app.sensor_history_size': "
+            f"{_app_config.sensor_history_size!r} (must be at least 1)"
+        )
+    if not hasattr(logging, _app_config.log_level):
+        raise ValueError(f"Unknown log_level: {_app_config.log_level}")
+    if _app_config.mqtt_transport not in TRANSPORTS:
+        raise ValueError(
+            f"Unknown mqtt_transport: {_app_config.mqtt_transport} "
+            f"- must be one of {TRANSPORTS}"
+        )
+    return _app_config, _current_state
+
+
+def _migrate_dose_duration(
+    app_config, current_state, dose_duration, has_dose_volume: bool
+) -> None:
+    """Convert the dose_duration (s) of an old config file to a dose_volume (ml)."""
+    if has_dose_volume:
+        _LOG.warning("Ignoring 'state.dose_duration' - 'state.dose_volume' is set")
+        return
+    if (
+        isinstance(dose_duration, bool)
+        or not isinstance(dose_duration, (int, float))
+        or not math.isfinite(dose_duration)
+        or dose_duration <= 0
+    ):
+        raise ValueError(f"Invalid value for 'state.dose_duration': {dose_duration!r}")
+    try:
+        flow_rate = read_pump_calibration(app_config.pump_calibration_file).flow_rate(
+            app_config.motor_channel
+        )
+    except (IOError, ValueError) as e:
+        _LOG.warning("Cannot read pump calibration: %s", e)
+        flow_rate = DEFAULT_FLOW_RATE
+    current_state.dose_volume = round(dose_duration * flow_rate, 3)
+    _LOG.warning(
+        "'state.dose_duration' is deprecated - dosing %s ml (%s s at %s ml/s). "
+        "Replace it with 'state.dose_volume' in the config file.",
+        current_state.dose_volume,
+        dose_duration,
+        flow_rate,
+    )
+
+
+def _check_field_types(instance, section: str) -> None:
+    """Check that the simply-typed fields of a dataclass hold values of the right type."""
+    for field in dataclasses.fields(instance):
+        if field.type not in (bool, int, float, str):
+            continue
+        value = getattr(instance, field.name)
+        if field.type is float:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+        elif field.type is int:
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, field.type)
+        if not valid:
+            raise ValueError(
+                f"Invalid value for '{section}.{field.name}': {value!r} "
+                f"(expected {field.type.__name__})"
+            )
 
 
 def process_config(
     file_path,
 ):
     """Process the configuration file."""
-    with open(file_path, "r", encoding="utf-8") as f:
-        yamls = yaml.safe_load(f)
-        if not "app" in yamls and not "state" in yamls:
-            raise AttributeError("Config file must contain 'app' and 'state' sections")
-        _app_config = AppConfig(**yamls["app"])
-        _current_state = AppState(**yamls["state"])
-
-    if not hasattr(logging, _app_config.log_level):
-        raise AttributeError(f"Unknown log_level: {_app_config.APP.log_level}")
+    _app_config, _current_state = load_config(file_path)
 
     calibration_data = read_calibration(_app_config.ec_calibration_file)
     _LOG.debug(
@@ -39,6 +148,13 @@ def process_config(
         calibration_data,
     )
     _current_state.calibration_data = calibration_data
+    _current_state.pump_calibration = read_pump_calibration(
+        _app_config.pump_calibration_file
+    )
+    _current_state.usage = read_usage(_app_config.usage_file)
+    _current_state.sensors = read_sensor_registry(
+        _app_config.mqttio_config_file, _app_config.sensor_history_size
+    )
 
     return _app_config, _current_state
 
@@ -53,11 +169,36 @@ class AppConfig:
     mqtt_port: int = 1883
     mqtt_username: str = "hamqtt"
     mqtt_password: str = "UbT4Rn3oY7!S9L"
+    # "mqtt" to use the broker directly, "local" for the in-process message bus
+    mqtt_transport: str = TRANSPORT_MQTT
+    # Whether the "local" transport forwards messages to and from the broker
+    mqtt_bridge: bool = True
     topic_prefix: str = "hydro"
     ec_prefix: str = "sensors/sensor/ec1"
     motor_channel: int = 0
     ec_calibration_file: str = "./ec-config.json"
+    pump_calibration_file: str = "./pump-config.json"
+    usage_file: str = "./usage.json"
+    ec_history_file: str = "./ec-history.bin"
+    dose_history_file: str = "./dose-history.bin"
+    # Directory with a history file for each mqtt-io sensor
+    sensor_history_dir: str = "./sensor-history"
     mqttio_config_file: str = "./mqtt-io.yml"
+    # Compensate EC readings to 25C with the latest reading from temperature_sensor.
+    # mqtt-io must then publish uncompensated EC (no tempsensor for the ec input).
+    ec_temperature_compensation: bool = True
+    temperature_sensor: str = "temperature"
+    # Age in seconds beyond which a temperature reading is too old to use
+    temperature_max_age: float = 60.0
+    # Number of readings kept in memory for each sensor
+    sensor_history_size: int = SENSOR_HISTORY_SIZE
+    # Age in seconds beyond which a sensor reading is too old to dose on
+    sensor_max_age: float = 60.0
+    # Age in seconds beyond which the EC is too old to dose on
+    ec_max_age: float = 60.0
+    # From the top-level pumps and recipe sections, None for a single pump on
+    # motor_channel dosing when the EC is below target
+    recipe: Union[Recipe, None] = None
     log_level: str = "INFO"
 
     def __repr__(self):
@@ -73,19 +214,33 @@ class AppState:
     control: bool = False
     calibration_data: Union[CalibrationData, None] = None
     manual_dose: bool = False
-    manual_dose_duration: int = 0
+    manual_dose_volume: float = 0.0  # ml
     equilibration_time: int = 3
     target_ec: float = 1.8
-    dose_duration: int = 5
+    dose_volume: float = 5.0  # ml
     # State variables
     current_ec: float = 999.0  # Set to a high value to prevent dosing before reading EC
+    current_temperature: Union[float, None] = None  # Used to compensate current_ec
     dose_count: int = 0
     last_dose_time: float = time.time() - equilibration_time
     total_dose_time: float = 0
+    total_dose_volume: float = 0.0  # ml
+    config_error: str = ""
+    pump_calibration: Union[PumpCalibration, None] = None
+    usage: Union[UsageRollups, None] = None
+    sensors: Union[SensorRegistry, None] = None
 
     def status_dict(self):
         """Return the variables as a dictionary."""
-        return dataclasses.asdict(self)
+        status = {}
+        for field in dataclasses.fields(self):
+            if field.name in STATUS_EXCLUDED_FIELDS:
+                continue
+            value = getattr(self, field.name)
+            if dataclasses.is_dataclass(value):
+                value = dataclasses.asdict(value)
+            status[field.name] = value
+        return status
 
     def status_json(self):
         """Return status as json string"""
@@ -0,0 +1,358 @@
+"""Message transports: a connection to an MQTT broker or an in-process message bus
+
+LocalTransport implements the parts of the paho mqtt.Client API that the app uses, so
+the controller and the mqtt_util callbacks work unchanged with either. On a single node
+it delivers messages in-process, so control never waits on a broker. An MqttBridge can
+forward traffic to and from an external broker (e.g. Home Assistant) in the background.
+
+mqtt-io runs in its own process and publishes its readings, including the EC, to the
+external broker, so they only reach the local bus through the bridge. Without the bridge,
+or while the broker is down, no readings arrive and the controller suspends dosing once
+the EC is older than ec_max_age.
+"""
+
+import collections
+import dataclasses
+import logging
+import queue
+import sys
+import threading
+from typing import Callable, Deque, Dict, List, Set, Tuple, Union
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.subscribeoptions import SubscribeOptions
+
+PY310 = sys.version_info >= (3, 10)
+TRANSPORT_MQTT = "mqtt"
+TRANSPORT_LOCAL = "local"
+TRANSPORTS = (TRANSPORT_MQTT, TRANSPORT_LOCAL)
+BRIDGE_QUEUE_SIZE = 1000
+
+_LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(**({"slots": True} if PY310 else {}))
+class Message:
+    """A message with the same attributes as paho's MQTTMessage."""
+
+    topic: str
+    payload: bytes = b""
+    qos: int = 0
+    retain: bool = False
+
+
+def encode_payload(payload) -> bytes:
+    """Convert a payload to bytes in the same way as paho."""
+    if payload is None:
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, bytearray):
+        return bytes(payload)
+    return str(payload).encode("utf-8")
+
+
+def topic_matches(subscription: str, topic: str) -> bool:
+    """Whether a topic matches a subscription that may contain + and # wildcards."""
+    sub_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level not in ("+", topic_levels[i]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class LocalTransport:
+    """In-process message bus with the subset of the paho mqtt.Client API used by the app.
+
+    Callbacks are run on a dispatcher thread started by loop_start(), as with paho.
+    Without the thread, loop() delivers the pending messages in the calling thread,
+    which makes this a fast, deterministic stand-in for a broker in tests.
+    """
+
+    def __init__(self):
+        self.on_connect: Union[Callable, None] = None
+        self.on_message: Union[Callable, None] = None
+        self.bridge: Union["MqttBridge", None] = None
+        self._exact: Set[str] = set()
+        self._wildcards: List[str] = []
+        self._retained: Dict[str, Message] = {}
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: Union[threading.Thread, None] = None
+        self._connected = False
+        self._mid = 0
+
+    def _next_mid(self) -> int:
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    # pylint: disable=unused-argument
+    def username_pw_set(self, username, password=None):
+        """Credentials aren't needed in-process."""
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        """Mark the transport connected and queue the on_connect callback."""
+        self._connected = True
+        self._queue.put(("connect", None))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        """Reconnect - this can't fail in-process."""
+        return self.connect()
+
+    def disconnect(self, *args, **kwargs):
+        """Disconnect and stop any bridge to a broker."""
+        self._connected = False
+        if self.bridge is not None:
+            self.bridge.stop()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self) -> bool:
+        """Return whether connect() has been called."""
+        return self._connected
+
+    def subscribe(self, topic: str, qos: int = 0, *args, **kwargs) -> Tuple[int, int]:
+        """Subscribe to a topic and queue any retained messages that match it."""
+        with self._lock:
+            if "+" in topic or "#" in topic:
+                if topic not in self._wildcards:
+                    self._wildcards.append(topic)
+            else:
+                self._exact.add(topic)
+            retained = [
+                m for t, m in self._retained.items() if topic_matches(topic, t)
+            ]
+        for message in retained:
+            self._queue.put(("message", message))
+        if self.bridge is not None:
+            self.bridge.subscribe(topic)
+        return mqtt.MQTT_ERR_SUCCESS, self._next_mid()
+
+    def unsubscribe(self, topic: str, *args, **kwargs) -> Tuple[int, int]:
+        """Remove a subscription."""
+        with self._lock:
+            self._exact.discard(topic)
+            if topic in self._wildcards:
+                self._wildcards.remove(topic)
+        if self.bridge is not None:
+            self.bridge.unsubscribe(topic)
+        return mqtt.MQTT_ERR_SUCCESS, self._next_mid()
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """Queue a message for local subscribers and forward it to any bridge."""
+        message = Message(topic, encode_payload(payload), qos, retain)
+        self.deliver(message)
+        if self.bridge is not None:
+            self.bridge.forward(message)
+        return mqtt.MQTT_ERR_SUCCESS, self._next_mid()
+
+    def deliver(self, message: Message) -> None:
+        """Queue a message for local subscribers only."""
+        if message.retain:
+            with self._lock:
+                self._retained[message.topic] = message
+        self._queue.put(("message", message))
+
+    def subscribed(self, topic: str) -> bool:
+        """Whether any subscription matches the topic."""
+        if topic in self._exact:
+            return True
+        return any(topic_matches(sub, topic) for sub in self._wildcards)
+
+    def _dispatch(self, event: str, message: Union[Message, None]) -> None:
+        try:
+            if event == "connect":
+                if self.on_connect is not None:
+                    self.on_connect(self, None, {}, 0, None)
+            elif self.on_message is not None and self.subscribed(message.topic):
+                self.on_message(self, None, message)
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception("Error in LocalTransport callback")
+
+    def loop(self, timeout: float = 0.0) -> int:
+        """Deliver pending messages in the calling thread and return how many were handled.
+
+        Waits up to timeout seconds for the first message.
+        """
+        handled = 0
+        try:
+            item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+            while item is not None:
+                self._dispatch(*item)
+                handled += 1
+                item = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        return handled
+
+    def _loop_forever(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._dispatch(*item)
+
+    def loop_start(self):
+        """Start delivering messages on a background thread."""
+        if self._thread is not None:
+            return mqtt.MQTT_ERR_INVAL
+        self._thread = threading.Thread(target=self._loop_forever, daemon=True)
+        self._thread.start()
+        if self.bridge is not None:
+            self.bridge.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self):
+        """Stop the background delivery thread."""
+        if self._thread is None:
+            return mqtt.MQTT_ERR_INVAL
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        return mqtt.MQTT_ERR_SUCCESS
+
+
+class MqttBridge:
+    """Mirrors a LocalTransport to an external MQTT broker without ever blocking it.
+
+    Local subscriptions are mirrored on the broker and matching broker messages are
+    delivered locally. Local publishes are queued and sent to the broker from a worker
+    thread; while the broker is unreachable at most queue_size messages are kept, the
+    oldest being dropped. paho reconnects in the background, so a broker outage only
+    delays forwarding. Subscriptions use MQTT v5 no-local so forwarded messages aren't
+    echoed back to the local bus.
+    """
+
+    def __init__(
+        self,
+        local: LocalTransport,
+        host: str,
+        port: int,
+        username: str = None,
+        password: str = None,
+        queue_size: int = BRIDGE_QUEUE_SIZE,
+    ):
+        self.local = local
+        self.host = host
+        self.port = port
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self._topics: Set[str] = set()
+        self._pending: Deque[Message] = collections.deque(maxlen=queue_size)
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Union[threading.Thread, None] = None
+        local.bridge = self
+
+    def start(self) -> None:
+        """Connect to the broker in the background and start forwarding."""
+        if self._running:
+            return
+        self._running = True
+        self.client.connect_async(self.host, port=self.port)
+        self.client.loop_start()
+        self._thread = threading.Thread(target=self._forward_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Disconnect from the broker and stop forwarding."""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def subscribe(self, topic: str) -> None:
+        """Mirror a local subscription on the broker."""
+        self._topics.add(topic)
+        if self.client.is_connected():
+            self.client.subscribe(topic, options=SubscribeOptions(noLocal=True))
+
+    def unsubscribe(self, topic: str) -> None:
+        """Remove a mirrored subscription."""
+        self._topics.discard(topic)
+        if self.client.is_connected():
+            self.client.unsubscribe(topic)
+
+    def forward(self, message: Message) -> None:
+        """Queue a local message to be published on the broker."""
+        with self._condition:
+            if len(self._pending) == self._pending.maxlen:
+                _LOG.debug("Bridge queue full - dropping oldest message")
+            self._pending.append(message)
+            self._condition.notify()
+
+    def _on_connect(self, client, _userdata, _flags, reason_code, _properties):
+        if reason_code != 0:
+            _LOG.warning("Bridge could not connect to MQTT broker: %s", reason_code)
+            return
+        _LOG.info("Bridge connected to MQTT broker %s:%s", self.host, self.port)
+        for topic in list(self._topics):
+            client.subscribe(topic, options=SubscribeOptions(noLocal=True))
+        with self._condition:
+            self._condition.notify()
+
+    def _on_message(self, _client, _userdata, message):
+        self.local.deliver(
+            Message(message.topic, message.payload, message.qos, message.retain)
+        )
+
+    def _forward_forever(self) -> None:
+        while True:
+            with self._condition:
+                while self._running and not (
+                    self._pending and self.client.is_connected()
+                ):
+                    self._condition.wait(timeout=1.0)
+                if not self._running:
+                    return
+                message = self._pending.popleft()
+            info = self.client.publish(
+                message.topic, message.payload, message.qos, message.retain
+            )
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                _LOG.debug("Bridge failed to forward message on %s", message.topic)
+
+
+def create_transport(
+    transport: str,
+    host: str,
+    port: int,
+    username: str = None,
+    password: str = None,
+    bridge: bool = True,
+):
+    """Create and connect a transport.
+
+    For TRANSPORT_MQTT this is a paho mqtt.Client connected to the broker. For
+    TRANSPORT_LOCAL it is a LocalTransport, bridged to the broker if bridge is True.
+    """
+    if transport == TRANSPORT_LOCAL:
+        client = LocalTransport()
+        if bridge:
+            MqttBridge(client, host, port, username, password)
+        else:
+            _LOG.warning(
+                "Local transport without a bridge - readings that mqtt-io publishes "
+                "to the broker will not be received"
+            )
+        client.connect()
+        return client
+    if transport != TRANSPORT_MQTT:
+        raise ValueError(f"Unknown transport: {transport} - must be one of {TRANSPORTS}")
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(username, password)
+    client.connect(host, port=port)
+    return client
@@ -0,0 +1,191 @@
+"""Incremental rollups of dosing usage by hour, day and week"""
+
+from array import array
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Union
+
+USAGE_FILE_ENCODING = "ascii"
+USAGE_FILE_VERSION = 2
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+# The epoch was a Thursday, so shift by 3 days to start weeks on a Monday
+WEEK_ALIGNMENT = 3 * DAY
+# Period name: (period length, alignment, number of periods kept)
+ROLLUP_PERIODS = {
+    "hour": (HOUR, 0, 7 * 24),
+    "day": (DAY, 0, 92),
+    "week": (WEEK, WEEK_ALIGNMENT, 104),
+}
+
+_LOG = logging.getLogger(__name__)
+
+
+def _utc_offset(timestamp: float) -> int:
+    """Offset of local time from UTC so that days and weeks follow the local clock."""
+    return time.localtime(timestamp).tm_gmtoff
+
+
+class RollupSeries:
+    """Ring buffer of dose counts, pump seconds and volumes for consecutive periods.
+
+    Each slot holds the totals for one period. The period a slot belongs to is stored
+    alongside it so that stale slots are reset lazily when they are reused, which keeps
+    updates O(1) however long it is between doses.
+    """
+
+    def __init__(self, length: int, alignment: int, size: int):
+        self.length = length
+        self.alignment = alignment
+        self.size = size
+        self.periods = array("q", [-1] * size)
+        self.dose_count = array("L", [0] * size)
+        self.dose_time = array("d", [0.0] * size)
+        self.dose_volume = array("d", [0.0] * size)
+
+    def period(self, timestamp: float) -> int:
+        """Index of the period containing timestamp."""
+        return int(timestamp + _utc_offset(timestamp) + self.alignment) // self.length
+
+    def period_start(self, period: int) -> float:
+        """Timestamp of the start of a period."""
+        start = period * self.length - self.alignment
+        return float(start - _utc_offset(start))
+
+    def add(self, timestamp: float, duration: float, volume: float) -> None:
+        """Add a dose at timestamp."""
+        period = self.period(timestamp)
+        slot = period % self.size
+        if self.periods[slot] != period:
+            if self.periods[slot] > period:
+                _LOG.warning("Ignoring dose older than the usage history: %s", timestamp)
+                return
+            self.periods[slot] = period
+            self.dose_count[slot] = 0
+            self.dose_time[slot] = 0.0
+            self.dose_volume[slot] = 0.0
+        self.dose_count[slot] += 1
+        self.dose_time[slot] += duration
+        self.dose_volume[slot] += volume
+
+    def series(self, now: float, since: float = 0.0) -> List[Dict]:
+        """Totals for each period held, oldest first, including empty periods."""
+        current = self.period(now)
+        # Only the periods held matter, which keeps since in the range of localtime()
+        since = min(max(since, now - self.size * self.length), now + self.length)
+        first = max(current - self.size + 1, self.period(since))
+        entries = []
+        for period in range(first, current + 1):
+            slot = period % self.size
+            held = self.periods[slot] == period
+            entries.append(
+                {
+                    "start": self.period_start(period),
+                    "dose_count": self.dose_count[slot] if held else 0,
+                    "dose_time": self.dose_time[slot] if held else 0.0,
+                    "dose_volume": self.dose_volume[slot] if held else 0.0,
+                }
+            )
+        return entries
+
+    def to_dict(self) -> Dict:
+        """Return the series as a dictionary for serialisation."""
+        return {
+            "periods": self.periods.tolist(),
+            "dose_count": self.dose_count.tolist(),
+            "dose_time": self.dose_time.tolist(),
+            "dose_volume": self.dose_volume.tolist(),
+        }
+
+    def load(self, data: Dict) -> None:
+        """Load a serialised series, ignoring it if it was saved with a different size."""
+        if len(data["periods"]) != self.size:
+            _LOG.warning("Discarding usage series saved with a different size")
+            return
+        self.periods = array("q", data["periods"])
+        self.dose_count = array("L", data["dose_count"])
+        self.dose_time = array("d", data["dose_time"])
+        # Version 1 files didn't record volumes
+        self.dose_volume = array("d", data.get("dose_volume", [0.0] * self.size))
+
+
+class UsageRollups:
+    """Hourly, daily and weekly dosing totals, updated as each dose happens.
+
+    Doses are recorded as the time the pump ran in seconds and the volume in ml.
+    """
+
+    def __init__(self):
+        self.series = {
+            name: RollupSeries(length, alignment, size)
+            for name, (length, alignment, size) in ROLLUP_PERIODS.items()
+        }
+        self.lock = threading.Lock()
+
+    def record_dose(self, timestamp: float, duration: float, volume: float) -> None:
+        """Add a dose to each of the rollups."""
+        with self.lock:
+            for series in self.series.values():
+                series.add(timestamp, duration, volume)
+
+    def status_dict(
+        self, period: Union[str, None] = None, since: float = 0.0, now: float = None
+    ) -> Dict[str, List[Dict]]:
+        """Return the totals for one or all of the periods.
+
+        Raises ValueError if since isn't finite.
+        """
+        if not math.isfinite(since):
+            raise ValueError(f"Invalid since: {since}")
+        if now is None:
+            now = time.time()
+        names = [period] if period else list(self.series)
+        with self.lock:
+            return {name: self.series[name].series(now, since) for name in names}
+
+    def to_dict(self) -> Dict:
+        """Return the rollups as a dictionary for serialisation."""
+        with self.lock:
+            data = {name: series.to_dict() for name, series in self.series.items()}
+        data["version"] = USAGE_FILE_VERSION
+        return data
+
+    def load(self, data: Dict) -> None:
+        """Load serialised rollups."""
+        with self.lock:
+            for name, series in self.series.items():
+                if name in data:
+                    series.load(data[name])
+
+
+def read_usage(usage_file: str) -> UsageRollups:
+    """Read usage rollups from json file."""
+    usage = UsageRollups()
+    if not os.path.exists(usage_file):
+        _LOG.info("Usage file not found: %s - starting new usage history.", usage_file)
+        return usage
+    try:
+        with open(usage_file, "r", encoding=USAGE_FILE_ENCODING) as file_handle:
+            usage.load(json.load(file_handle))
+    except (IOError, ValueError, KeyError) as exc:
+        _LOG.warning("Failed to read usage file %s: %s", usage_file, exc)
+    return usage
+
+
+def write_usage(usage: UsageRollups, usage_file: str) -> None:
+    """Write usage rollups to json file.
+
+    The file is replaced atomically so a power cut can't leave it half written.
+    """
+    tmp_file = f"{usage_file}.tmp"
+    try:
+        with open(tmp_file, "w", encoding=USAGE_FILE_ENCODING) as file_handle:
+            json.dump(usage.to_dict(), file_handle)
+        os.replace(tmp_file, usage_file)
+    except IOError as exc:
+        _LOG.warning("Failed to write usage data: %s", exc)
@@ -9,6 +9,11 @@ function updateState() {
 function updateStatus(data) {
   const current_ec = document.getElementById("current-ec");
   current_ec.innerText = data.state.current_ec.toFixed(2);
+  const current_temperature = document.getElementById("current-temperature");
+  current_temperature.innerText =
+    data.state.current_temperature === null
+      ? "-"
+      : data.state.current_temperature.toFixed(1);
   const dose_time = document.getElementById("last-dosetime");
   dose_time.innerText = new Date(
     data.state.last_dose_time * 1000
@@ -16,7 +21,11 @@ function updateStatus(data) {
   const dose_count = document.getElementById("dose-count");
   dose_count.innerText = data.state.dose_count;
   const total_dose_time = document.getElementById("total-dose-time");
-  total_dose_time.innerText = data.state.total_dose_time;
+  total_dose_time.innerText = data.state.total_dose_time.toFixed(1);
+  const total_dose_volume = document.getElementById("total-dose-volume");
+  total_dose_volume.innerText = data.state.total_dose_volume.toFixed(1);
+  const config_error = document.getElementById("config-error");
+  config_error.innerText = data.state.config_error;
   const calibration_temperature = document.getElementById(
     "calibrate-ecprobe-temperature"
   );
@@ -25,6 +34,10 @@ function updateStatus(data) {
     "calibrate-ecprobe-status"
   );
   calibration_status.innerText = data.state.calibration_data.message;
+  const pump_calibration_status = document.getElementById(
+    "calibrate-pump-status"
+  );
+  pump_calibration_status.innerText = data.state.pump_calibration.message;
 }
 
 function addParamsSubmit(ev) {
@@ -42,9 +55,9 @@ function addParamsSubmit(ev) {
 
 function paramsUpdate(parameters) {
   // We reset the parameters in case the server has changed them
-  if ("dose_duration" in parameters) {
-    const dose_duration = document.getElementById("dose-duration");
-    dose_duration.value = parameters.dose_duration;
+  if ("dose_volume" in parameters) {
+    const dose_volume = document.getElementById("dose-volume");
+    dose_volume.value = parameters.dose_volume;
   }
   if ("equilibration_time" in parameters) {
     const equilibration_time = document.getElementById("equilibration-time");
@@ -88,4 +101,21 @@ function addCalibrateSubmit(ev) {
 var form = document.getElementById("calibrate-ecprobe");
 form.addEventListener("submit", addCalibrateSubmit);
 
+function addCalibratePumpSubmit(ev) {
+  ev.preventDefault();
+  const formData = new FormData(this);
+  const url = new URL(this.id.replace(/-/g, "_"), baseUrl);
+  fetch(url, {
+    method: "POST",
+    body: formData,
+  });
+  ev.submitter.blur(); // Remove focus from the button
+  updateState();
+}
+
+var form = document.getElementById("calibrate-pump");
+form.addEventListener("submit", addCalibratePumpSubmit);
+var form = document.getElementById("calibrate-pump-volume");
+form.addEventListener("submit", addCalibratePumpSubmit);
+
 setInterval(updateState, 5000);
@@ -2,12 +2,29 @@
 
 # import json
 import logging
+import math
 import time
 from flask import jsonify
 from flask import render_template
 from flask import request
+from flask import Response
 
+from hydrocontrol_ui.hydrocontrol.dose_history import DoseHistory
 from hydrocontrol_ui.hydrocontrol.ec_calibrator import CalibrationStatus
+from hydrocontrol_ui.hydrocontrol.ec_history import EcHistory
+from hydrocontrol_ui.hydrocontrol.export import (
+    FORMAT_CSV,
+    FORMAT_MIMETYPES,
+    SOURCE_DOSES,
+    SOURCE_EC,
+    export_history,
+    parse_export_args,
+)
+from hydrocontrol_ui.hydrocontrol.pump_calibrator import PumpCalibrationStatus
+from hydrocontrol_ui.hydrocontrol.recipe import pump_channels
+from hydrocontrol_ui.hydrocontrol.sensor_history import SensorHistory
+from hydrocontrol_ui.hydrocontrol.state_classes import AppConfig
+from hydrocontrol_ui.hydrocontrol.usage import ROLLUP_PERIODS
 
 
 # from mqtt_util import ID_CALIBRATE, ID_CONTROL, ID_MANUAL_DOSE, ID_PARAMETERS
@@ -15,6 +32,8 @@ from hydrocontrol_ui.hydrocontrol.ec_calibrator import CalibrationStatus
 from . import app
 
 APP_STATE = app.config["APP_STATE"]
+# Shared with the HydroController so the history files follow config changes
+APP_CONFIG = app.config.get("APP_CONFIG", AppConfig())
 
 _LOG = logging.getLogger(__name__)
 
@@ -50,12 +69,18 @@ def control():
     except ValueError:
         _LOG.debug("Error getting target_ec: %s", target_ec)
         return {"status": "failure"}, 422
-    dose_duration = request.form["dose-duration"]
+    if not math.isfinite(target_ec):
+        _LOG.debug("Invalid target_ec: %s", target_ec)
+        return {"status": "failure"}, 400
+    dose_volume = request.form["dose-volume"]
     try:
-        dose_duration = int(dose_duration)
+        dose_volume = float(dose_volume)
     except ValueError:
-        _LOG.debug("Error getting dose_duration: %s", target_ec)
+        _LOG.debug("Error getting dose_volume: %s", dose_volume)
         return {"status": "failure"}, 422
+    if not (math.isfinite(dose_volume) and dose_volume > 0):
+        _LOG.debug("Invalid dose_volume: %s", dose_volume)
+        return {"status": "failure"}, 400
     equilibration_time = request.form["equilibration-time"]
     try:
         equilibration_time = int(equilibration_time)
@@ -67,9 +92,9 @@ def control():
     if target_ec != APP_STATE.target_ec:
         APP_STATE.target_ec = target_ec
         parameters["target_ec"] = target_ec
-    if dose_duration != APP_STATE.dose_duration:
-        APP_STATE.dose_duration = dose_duration
-        parameters["dose_duration"] = dose_duration
+    if dose_volume != APP_STATE.dose_volume:
+        APP_STATE.dose_volume = dose_volume
+        parameters["dose_volume"] = dose_volume
     if equilibration_time != APP_STATE.equilibration_time:
         APP_STATE.equilibration_time = equilibration_time
         parameters["equilibration_time"] = equilibration_time
@@ -82,17 +107,20 @@ def control():
 
 @app.route("/dose", methods=["POST"])
 def dose():
-    duration = request.form["manual-dose-duration"]
+    volume = request.form["manual-dose-volume"]
     try:
-        duration = int(duration)
+        volume = float(volume)
     except ValueError:
-        _LOG.debug("Error getting dose duration: %s", duration)
+        _LOG.debug("Error getting dose volume: %s", volume)
         data = {"status": "failure"}
         return data, 422
-    _LOG.info("Setting manual dose: %s", duration)
-    # mqtt.publish(mqtt_topics[ID_MANUAL_DOSE], str(duration))
+    if not (math.isfinite(volume) and volume > 0):
+        _LOG.debug("Invalid dose volume: %s", volume)
+        return {"status": "failure"}, 400
+    _LOG.info("Setting manual dose: %s", volume)
+    # mqtt.publish(mqtt_topics[ID_MANUAL_DOSE], str(volume))
+    APP_STATE.manual_dose_volume = volume
     APP_STATE.manual_dose = True
-    APP_STATE.manual_dose_duration = duration
     return {"status": "success"}, 200
 
 
@@ -105,17 +133,170 @@ def calibrate_ec():
         msg = f"Invalid temperature for calibration: '{temperature}'"
         _LOG.info(msg)
         APP_STATE.calibration_data.status = CalibrationStatus.ERROR
-        APP_STATE.alibration_data.message = msg
+        APP_STATE.calibration_data.message = msg
         data = {"status": "failure"}
         return data, 422
-    _LOG.info("Calibrate ecprobe: %s", temperature)
+    # An empty buffer solution means detect which standard buffer is in use
+    buffer_solution = request.form.get("calibrate-ecprobe-buffer", "") or "-1"
+    try:
+        buffer_solution = float(buffer_solution)
+    except ValueError:
+        msg = f"Invalid buffer solution for calibration: '{buffer_solution}'"
+        _LOG.info(msg)
+        APP_STATE.calibration_data.status = CalibrationStatus.ERROR
+        APP_STATE.calibration_data.message = msg
+        data = {"status": "failure"}
+        return data, 422
+    _LOG.info("Calibrate ecprobe: %s buffer: %s", temperature, buffer_solution)
     # mqtt.publish(mqtt_topics[ID_CALIBRATE], "ec")
     APP_STATE.calibration_data.status = CalibrationStatus.CALIBRATING
     APP_STATE.calibration_data.message = "Calibrating..."
     APP_STATE.calibration_data.temperature = temperature
+    APP_STATE.calibration_data.buffer_solution = buffer_solution
+    return {"status": "success"}, 200
+
+
+@app.route("/calibrate_pump", methods=["POST"])
+def calibrate_pump():
+    pump_calibration = APP_STATE.pump_calibration
+    duration = request.form["calibrate-pump-duration"]
+    try:
+        duration = float(duration)
+    except ValueError:
+        duration = -1.0
+    if not (math.isfinite(duration) and duration > 0):
+        msg = f"Invalid duration for pump calibration: '{duration}'"
+        _LOG.info(msg)
+        pump_calibration.status = PumpCalibrationStatus.ERROR
+        pump_calibration.message = msg
+        return {"status": "failure"}, 422
+    channel = request.form.get("calibrate-pump-channel")
+    if channel is not None:
+        channels = pump_channels(APP_CONFIG.recipe, APP_CONFIG.motor_channel)
+        try:
+            channel = int(channel)
+        except ValueError:
+            channel = None
+        if channel not in channels:
+            msg = (
+                "Invalid channel for pump calibration: "
+                f"'{request.form['calibrate-pump-channel']}' - must be one of {channels}"
+            )
+            _LOG.info(msg)
+            pump_calibration.status = PumpCalibrationStatus.ERROR
+            pump_calibration.message = msg
+            return {"status": "failure"}, 422
+        pump_calibration.channel = channel
+    _LOG.info(
+        "Calibrate pump: running channel %d for %s s", pump_calibration.channel, duration
+    )
+    pump_calibration.duration = duration
+    pump_calibration.measured_volume = 0.0
+    pump_calibration.message = f"Running pump for {duration} s..."
+    pump_calibration.status = PumpCalibrationStatus.RUNNING
+    return {"status": "success"}, 200
+
+
+@app.route("/calibrate_pump_volume", methods=["POST"])
+def calibrate_pump_volume():
+    pump_calibration = APP_STATE.pump_calibration
+    if pump_calibration.status != PumpCalibrationStatus.MEASURING:
+        pump_calibration.message = "Run the pump before entering the volume pumped"
+        return {"status": "failure"}, 409
+    volume = request.form["calibrate-pump-volume"]
+    try:
+        volume = float(volume)
+    except ValueError:
+        volume = -1.0
+    if not (math.isfinite(volume) and volume > 0):
+        msg = f"Invalid volume for pump calibration: '{volume}'"
+        _LOG.info(msg)
+        pump_calibration.message = msg
+        return {"status": "failure"}, 422
+    _LOG.info("Calibrate pump: measured volume %s ml", volume)
+    pump_calibration.measured_volume = volume
     return {"status": "success"}, 200
 
 
 @app.route("/status")
 def status():
     return jsonify(state=APP_STATE.status_dict())
+
+
+@app.route("/usage")
+def usage():
+    period = request.args.get("period")
+    if period is not None and period not in ROLLUP_PERIODS:
+        _LOG.debug("Invalid usage period: %s", period)
+        return {"status": "failure"}, 422
+    try:
+        since = float(request.args.get("since", 0.0))
+    except ValueError:
+        _LOG.debug("Invalid usage since: %s", request.args.get("since"))
+        return {"status": "failure"}, 422
+    if not math.isfinite(since):
+        _LOG.debug("Invalid usage since: %s", since)
+        return {"status": "failure"}, 400
+    if APP_STATE.usage is None:
+        return jsonify(usage={})
+    return jsonify(usage=APP_STATE.usage.status_dict(period, since))
+
+
+@app.route("/sensors")
+def sensors():
+    if APP_STATE.sensors is None:
+        return jsonify(sensors={})
+    return jsonify(sensors=APP_STATE.sensors.status_dict())
+
+
+@app.route("/sensors/<name>")
+def sensor_history(name):
+    sensor = APP_STATE.sensors.get(name) if APP_STATE.sensors is not None else None
+    if sensor is None:
+        return {"status": "failure", "message": f"Unknown sensor: {name}"}, 404
+    # Invalid values are ignored, returning the whole history
+    since = request.args.get("since", type=float)
+    limit = request.args.get("limit", type=int)
+    times, values = sensor.series(since, limit)
+    return jsonify(
+        name=name,
+        type=sensor.sensor_type,
+        times=times.tolist(),
+        values=values.tolist(),
+    )
+
+
+@app.route("/export")
+def export():
+    source = request.args.get("source", SOURCE_EC)
+    export_format = request.args.get("format", FORMAT_CSV)
+    try:
+        start, end, resolution = parse_export_args(
+            request.args.get("start"),
+            request.args.get("end"),
+            request.args.get("resolution"),
+        )
+        sensor_histories = SensorHistory(APP_CONFIG.sensor_history_dir)
+        if source not in (SOURCE_EC, SOURCE_DOSES, *sensor_histories.names()):
+            return {"status": "failure", "message": f"Unknown source: {source}"}, 404
+        parts = export_history(
+            source,
+            EcHistory(APP_CONFIG.ec_history_file),
+            DoseHistory(APP_CONFIG.dose_history_file),
+            start,
+            end,
+            export_format,
+            resolution,
+            sensor_histories,
+        )
+    except ValueError as e:
+        _LOG.debug("Invalid export request: %s", e)
+        return {"status": "failure", "message": str(e)}, 422
+    # The export is generated as it is sent, so memory use is the same for any size
+    return Response(
+        parts,
+        mimetype=FORMAT_MIMETYPES[export_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={source}.{export_format}"
+        },
+    )
@@ -0,0 +1,57 @@
+"""Tests for the streaming history export"""
+
+import numpy as np
+
+from hydrocontrol_ui.hydrocontrol.dose_history import DOSE_DTYPE
+from hydrocontrol_ui.hydrocontrol.ec_history import HISTORY_DTYPE
+from hydrocontrol_ui.hydrocontrol.export import csv_rows
+
+# Values where rounding to 6 significant digits changes the exponent or the digits
+EDGE_VALUES = [
+    0.0,
+    -0.0,
+    999999.5,
+    99999.95,
+    1e-5,
+    -1.2345e-4,
+    123456789.0,
+    np.nan,
+    np.inf,
+    -np.inf,
+]
+
+
+def expected_rows(records):
+    """The CSV rows with each value written by the % operator."""
+    # pylint: disable=consider-using-f-string
+    return [
+        ",".join(
+            "%.3f" % value if name == "time" else "%.6g" % value
+            for name, value in zip(records.dtype.names, record.tolist())
+        )
+        for record in records
+    ]
+
+
+def test_csv_matches_percent_g():
+    """CSV values are written exactly as %.6g and times as %.3f."""
+    rng = np.random.default_rng(0)
+    records = np.zeros(10000, dtype=HISTORY_DTYPE)
+    records["time"] = 1.7e9 + rng.uniform(0, 1e6, len(records))
+    for name in ("voltage", "temperature", "ec", "ec_corrected"):
+        records[name] = rng.lognormal(0, 5, len(records)) * rng.choice([-1, 1])
+    records["ec"][: len(EDGE_VALUES)] = EDGE_VALUES
+
+    lines = "".join(csv_rows([records[:4000], records[4000:]], HISTORY_DTYPE))
+    header, *rows = lines.splitlines()
+    assert header == ",".join(HISTORY_DTYPE.names)
+    assert rows == expected_rows(records)
+
+
+def test_csv_integer_columns():
+    """Integer columns are written as integers."""
+    records = np.array(
+        [(1.7e9, 3, 2.5, 0.1), (1.7e9 + 1, -1, 0.0, 1e6)], dtype=DOSE_DTYPE
+    )
+    rows = "".join(csv_rows([records], DOSE_DTYPE)).splitlines()[1:]
+    assert rows == ["1700000000.000,3,2.5,0.1", "1700000001.000,-1,0,1e+06"]